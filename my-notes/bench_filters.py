@@ -0,0 +1,116 @@
+'''
+Benchmark filtered vector searches against unfiltered ones.
+
+    python bench_filters.py                                   # 50k vectors, every index kind
+    python bench_filters.py --size 200000 --kinds hnsw npy32 --json bench-results/filters.json
+
+Every random unit vector gets made up metadata: tag p50 on half the notes,
+p20 on a fifth and so on down to p01 on one in a thousand, one of the three
+sources and a created time spread over two years. For each index kind it
+measures, per filter:
+    select      - ms for FilterIndex.select() to build the allowed set, uncached
+    query       - ms per query of search_many() in batches of --batch, the allowed rows already cached
+    recall      - recall@k against exact search over just the allowed vectors
+The first row of each kind is the unfiltered search.
+'''
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+
+import note_log
+import note_filters
+import notes_index
+from bench_vectors import make_vectors, make_queries
+
+MODEL_NAME = 'bench-filters'
+TAG_SHARES = {'p50': 0.5, 'p20': 0.2, 'p05': 0.05, 'p01': 0.01, 'p001': 0.001}
+DAY = 86400
+
+
+def make_filters(ids, seed=0):
+    rng = random.Random(seed)
+    now = time.time()
+    filters = note_filters.FilterIndex()
+    filters.add_many([(note_id, [tag for tag, share in TAG_SHARES.items() if rng.random() < share],
+                       rng.choice(note_log.SOURCES), now - rng.random() * 730 * DAY) for note_id in ids])
+    return filters
+
+
+def filter_cases():
+    now = time.time()
+    cases = [('none', {})]
+    cases += [(f'#{tag}', {'tags': [tag]}) for tag in TAG_SHARES]
+    cases += [('#p50 #p20 file', {'tags': ['p50', 'p20'], 'sources': ['file']}),
+              ('last 30 days', {'after': now - 30 * DAY}),
+              ('#p20 last year', {'tags': ['p20'], 'after': now - 365 * DAY})]
+    return cases
+
+
+def exact_hits(vectors, ids, queries, allowed, k):
+    rows = np.array([row for row, note_id in enumerate(ids) if allowed is None or note_id in allowed], dtype='int64')
+    if not len(rows):
+        return [[] for _ in queries]
+    _, found = notes_index.exact_top_k([vectors[rows]], queries, min(k, len(rows)))
+    return [[ids[row] for row in rows[query_rows]] for query_rows in found]
+
+
+def measure(index, queries, allowed, k, batch):
+    index.search_many(queries[:batch].copy(), k, allowed)
+    hits = []
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch):
+        hits += index.search_many(queries[start:start + batch].copy(), k, allowed)
+    return 1000 * (time.perf_counter() - started) / len(queries), [[note_id for note_id, _ in query_hits] for query_hits in hits]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=50_000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--kinds', nargs='+', default=notes_index.INDEX_KINDS, choices=notes_index.INDEX_KINDS)
+    parser.add_argument('--queries', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.size, args.dim)
+    queries = make_queries(vectors, args.queries)
+    ids = [str(row) for row in range(len(vectors))]
+    filters = make_filters(ids)
+    print(f'{args.size} vectors of {args.dim} dimensions')
+
+    selections = []
+    for name, case in filter_cases():
+        started = time.perf_counter()
+        allowed = filters.select(**case)
+        select_ms = 1000 * (time.perf_counter() - started)
+        selections.append((name, allowed, select_ms, exact_hits(vectors, ids, queries, allowed, args.k)))
+
+    rows = []
+    for kind in args.kinds:
+        if kind in notes_index.NUMPY_KINDS:
+            index = notes_index.NumpyIndex(args.dim, MODEL_NAME, kind=kind)
+        else:
+            faiss_index = notes_index.make_faiss_index(kind, args.dim, len(vectors))
+            notes_index.train(faiss_index, vectors)
+            index = notes_index.NotesIndex(args.dim, MODEL_NAME, index=faiss_index, kind=kind)
+        index.add(ids, ids, vectors)
+        for name, allowed, select_ms, exact in selections:
+            query_ms, found = measure(index, queries, allowed, args.k, args.batch)
+            expected = sum(len(hits) for hits in exact)
+            recall = sum(len(set(a) & set(b)) for a, b in zip(found, exact)) / expected if expected else 1.0
+            rows.append({'kind': kind, 'filter': name, 'allowed': len(allowed) if allowed is not None else len(ids),
+                         'select_ms': select_ms, 'query_ms': query_ms, 'recall_at_k': recall})
+            print(f"{kind:6} {name:16} {rows[-1]['allowed']:8} notes  select {select_ms:7.2f} ms  "
+                  f"query {query_ms:7.3f} ms  recall {recall:.3f}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'size': args.size, 'dim': args.dim, 'k': args.k, 'results': rows}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Micro-benchmark of the result formatter.
+
+    python bench_formatter.py [--repeat 20]
+
+Compares the old ten pass add_line_breaks() with formatter.format_note() and
+a RenderCache hit, on 10 KB code heavy notes made from synthetic_notes.py,
+both as written and flattened to one line like notes pasted into the app.
+Also counts the notes where the two formatters disagree.
+'''
+import re
+import time
+import argparse
+
+import synthetic_notes
+from formatter import format_note, RenderCache
+
+
+def add_line_breaks(text):
+    # The formatter my-notes.py used before formatter.py, kept here as the baseline
+    text = re.sub(r'(?<!\n)(###)', '\n###', text)
+    text = re.sub(r'(?<!\n)(####)', '\n####', text)
+    text = re.sub(r'(?<!\n)(?=\d+\.)', '\n', text)
+    text = re.sub(r'(?<!\n)(?=```)', '\n', text)
+    text = re.sub(r'(?<!\n)(?=-)', '\n', text)
+    text = re.sub(r'(```python)(?!\n)', r'\1\n', text)
+    text = re.sub(r'(?<!\n)(?=import)', '\n', text)
+    text = re.sub(r'(?<!\n)(?=async def)', '\n', text)
+    text = re.sub(r'\):', '):\n', text)
+    text = re.sub(r'\)(?=\s{4,})', ')\n', text)
+    return text
+
+
+def large_notes(count=50, size=10_000):
+    generated = synthetic_notes.generate_notes(count * 20)
+    notes = []
+    for _ in range(count):
+        note = ''
+        while len(note) < size:
+            note += next(generated) + '\n\n'
+        notes.append(note)
+    return notes + [re.sub(r'\s+', ' ', note) for note in notes]
+
+
+def throughput(function, notes, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for note in notes:
+            function(note)
+    seconds = time.perf_counter() - started
+    return sum(len(note) for note in notes) * repeat / seconds / 2**20, 1e6 * seconds / (repeat * len(notes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    notes = large_notes()
+    print(f'{len(notes)} notes, average {sum(map(len, notes)) // len(notes)} bytes')
+    cache = RenderCache()
+    for note_id, note in enumerate(notes):
+        cache.format(note_id, note)
+    cached = {note: note_id for note_id, note in enumerate(notes)}
+
+    for name, function in [('add_line_breaks (10 passes)', add_line_breaks),
+                           ('format_note (single pass)', format_note),
+                           ('RenderCache hit', lambda note: cache.format(cached[note], note))]:
+        mb_per_second, microseconds = throughput(function, notes, args.repeat)
+        print(f'{name:28} {mb_per_second:10.1f} MB/s {microseconds:10.1f} us/note')
+
+    differences = sum(add_line_breaks(note) != format_note(note) for note in notes)
+    print(f'{differences} of {len(notes)} notes format differently')
+
+
+if __name__ == '__main__':
+    main()
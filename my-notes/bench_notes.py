@@ -0,0 +1,206 @@
+'''
+Benchmark the notes pipeline on synthetic corpora.
+
+    python bench_notes.py                                   # 1k and 10k notes, hashing embedder
+    python bench_notes.py --sizes 1000 100000 1000000 --kind hnsw
+    python bench_notes.py --embedder model                  # the real sentence-transformers model
+    python bench_notes.py --compare bench-results/old.json bench-results/new.json
+
+For every corpus size a fresh process generates notes with synthetic_notes.py
+into a temp directory and measures:
+    ingest       - notes/s appended to the note log, in --batch sized commits
+    embed        - notes/s through the embedding cache (all misses)
+    index build  - seconds to build the vector index from cached vectors, and the BM25 index
+    query        - p50/p95/p99 ms of retrieval.search() over generated queries
+    peak RSS     - of that process
+    cold start   - a second fresh process opening the saved store and answering one query
+
+Results are written to bench-results/<time>-<commit>.json. --compare prints
+the ratio new/old for every metric of two result files.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+STARTED = time.perf_counter()
+
+import config
+import lexical
+import retrieval
+import note_log
+import notes_index
+import synthetic_notes
+from embedders import HashingEmbeddings
+from embedding_cache import EmbeddingCache
+
+RESULTS_DIR = 'bench-results'
+
+
+def open_embedder(name):
+    if name == 'hashing':
+        embedder = HashingEmbeddings()
+        return embedder, embedder.model_name
+    import warm_model
+    model = warm_model.get_model(config.EMBEDDING_MODEL_NAME)
+    model.wait()
+    return model, config.EMBEDDING_MODEL_NAME
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def open_store(workdir):
+    return note_log.NoteLog(os.path.join(workdir, 'notes.log'), os.path.join(workdir, 'notes.snapshot.json'))
+
+
+def run_one(size, args):
+    workdir = args.workdir
+    embedder, model_name = open_embedder(args.embedder)
+    result = {'notes': size}
+
+    started = time.perf_counter()
+    texts = list(synthetic_notes.generate_notes(size, seed=args.seed))
+    result['generate_seconds'] = time.perf_counter() - started
+    result['corpus_mb'] = sum(len(text) for text in texts) / 2**20
+
+    log = open_store(workdir)
+    started = time.perf_counter()
+    for start in range(0, size, args.batch):
+        log.add_many(texts[start:start + args.batch])
+    seconds = time.perf_counter() - started
+    result['ingest_notes_per_second'] = size / seconds
+    log.compact()
+    notes = log.copy_notes()
+    log.close()
+
+    embeddings = EmbeddingCache(embedder, model_name, os.path.join(workdir, 'embeddings'))
+    started = time.perf_counter()
+    embeddings.embed_documents(list(notes.values()))
+    result['embed_notes_per_second'] = len(notes) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    index = notes_index.build_index(notes, embeddings, model_name, args.kind)
+    result['index_build_seconds'] = time.perf_counter() - started
+    result['index_kind'] = index.kind
+    index.save(os.path.join(workdir, 'index'))
+
+    started = time.perf_counter()
+    lexical_index = lexical.build_lexical_index(notes)
+    result['lexical_build_seconds'] = time.perf_counter() - started
+
+    latencies = []
+    for query in synthetic_notes.generate_queries(args.queries):
+        started = time.perf_counter()
+        retrieval.search(query, index, lexical_index, embeddings, k=4)
+        latencies.append(1000 * (time.perf_counter() - started))
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        result[f'query_{name}_ms'] = percentile(latencies, fraction)
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def cold_start(args):
+    # Everything a fresh app process does before it can answer the first query
+    embedder, model_name = open_embedder(args.embedder)
+    log = open_store(args.workdir)
+    notes = log.copy_notes()
+    embeddings = EmbeddingCache(embedder, model_name, os.path.join(args.workdir, 'embeddings'))
+    index = notes_index.load_index(os.path.join(args.workdir, 'index'), model_name)
+    lexical_index = lexical.build_lexical_index(notes)
+    retrieval.search('how do I refresh a materialized view', index, lexical_index, embeddings)
+    return {'cold_start_seconds': time.perf_counter() - STARTED, 'cold_start_peak_rss_mb': peak_rss_mb()}
+
+
+def run_child(mode, size, args):
+    command = [sys.executable, __file__, mode, str(size), '--workdir', args.workdir, '--embedder', args.embedder,
+               '--queries', str(args.queries), '--batch', str(args.batch), '--seed', str(args.seed)]
+    if args.kind:
+        command += ['--kind', args.kind]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_path, new_path):
+    with open(old_path, 'r') as file:
+        old = {row['notes']: row for row in json.load(file)['results']}
+    with open(new_path, 'r') as file:
+        new = {row['notes']: row for row in json.load(file)['results']}
+    for size in sorted(set(old) & set(new)):
+        print(f'{size} notes')
+        for name, value in new[size].items():
+            if isinstance(value, (int, float)) and old[size].get(name) and name != 'notes':
+                print(f'    {name:28} {old[size][name]:12.3f} -> {value:12.3f}  x{value / old[size][name]:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', nargs='?', default='run', choices=['run', 'one', 'cold'], help=argparse.SUPPRESS)
+    parser.add_argument('size', nargs='?', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--embedder', choices=['hashing', 'model'], default='hashing')
+    parser.add_argument('--kind', choices=notes_index.INDEX_KINDS, help='index kind, picked from the size by default')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=100, help='notes per note log commit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help='result file, bench-results/<time>-<commit>.json by default')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.mode == 'one':
+        print(json.dumps(run_one(args.size, args)))
+        return
+    if args.mode == 'cold':
+        print(json.dumps(cold_start(args)))
+        return
+
+    results = []
+    for size in args.sizes:
+        args.workdir = tempfile.mkdtemp(prefix=f'bench-notes-{size}-')
+        try:
+            result = run_child('one', size, args)
+            started = time.perf_counter()
+            result.update(run_child('cold', size, args))
+            result['cold_start_wall_seconds'] = time.perf_counter() - started
+        finally:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+        results.append(result)
+        print(f"{size:>8} notes  ingest {result['ingest_notes_per_second']:9.0f}/s  embed {result['embed_notes_per_second']:8.0f}/s  "
+              f"build {result['index_build_seconds']:7.2f}s ({result['index_kind']})  query p50/p95/p99 "
+              f"{result['query_p50_ms']:.2f}/{result['query_p95_ms']:.2f}/{result['query_p99_ms']:.2f} ms  "
+              f"rss {result['peak_rss_mb']:.0f} MB  cold start {result['cold_start_wall_seconds']:.2f}s")
+
+    commit = git_commit()
+    out = args.out or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as file:
+        json.dump({'commit': commit, 'embedder': args.embedder, 'kind': args.kind, 'python': sys.version.split()[0],
+                   'created': time.time(), 'results': results}, file, indent=4)
+    print(f'wrote {out}')
+
+
+if __name__ == '__main__':
+    main()
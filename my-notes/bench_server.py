@@ -0,0 +1,137 @@
+'''
+Load test the query server.
+
+    python bench_server.py                                   # starts a synthetic server, 1/8/64 clients
+    python bench_server.py --window-ms 0 --max-batch 1       # same without micro-batching
+    python bench_server.py --embedder model                  # the real model, where batching pays off
+    python bench_server.py --url http://127.0.0.1:8765       # an already running server
+
+Every client is a thread with its own keep-alive connection that sends
+queries from synthetic_notes.generate_queries() back to back. For each
+concurrency level it prints throughput, p50/p95/p99 latency and the mean
+batch size the server formed.
+'''
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse
+
+import synthetic_notes
+from bench_notes import percentile
+
+
+def request(connection, method, path, body=None):
+    # Body as bytes so http.client sends it in the same packet as the headers
+    connection.request(method, path, body=json.dumps(body).encode('utf-8') if body is not None else None,
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f'{response.status}: {data[:200]}')
+    return json.loads(data)
+
+
+def run_level(host, port, concurrency, total, k):
+    queries = synthetic_notes.generate_queries(total)
+    latencies = [[] for _ in range(concurrency)]
+    errors = []
+
+    def client(number):
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            for query in queries[number::concurrency]:
+                started = time.perf_counter()
+                request(connection, 'POST', '/search', {'query': query, 'k': k})
+                latencies[number].append(1000 * (time.perf_counter() - started))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    before = request(connection, 'GET', '/stats')
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    after = request(connection, 'GET', '/stats')
+    connection.close()
+    if errors:
+        raise errors[0]
+
+    latencies = [latency for client_latencies in latencies for latency in client_latencies]
+    batches = after['batches'] - before['batches']
+    return {
+        'concurrency': concurrency,
+        'queries': len(latencies),
+        'queries_per_second': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_batch': (after['requests'] - before['requests']) / batches if batches else 0.0,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    port = free_port()
+    command = [sys.executable, 'query_server.py', '--port', str(port), '--synthetic', str(args.synthetic),
+               '--embedder', args.embedder, '--window-ms', str(args.window_ms), '--max-batch', str(args.max_batch)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    # The server prints one line once it is listening
+    server.stdout.readline()
+    return server, port
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server to test, otherwise a synthetic one is started')
+    parser.add_argument('--synthetic', type=int, default=10000, help='notes in the started server')
+    parser.add_argument('--embedder', choices=['hashing', 'model'], default='hashing', help='embedder of the started server')
+    parser.add_argument('--window-ms', type=float, default=5)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--requests', type=int, default=2000, help='queries per concurrency level')
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        server, port = start_server(args)
+        host = '127.0.0.1'
+    try:
+        results = []
+        for concurrency in args.concurrency:
+            result = run_level(host, port, concurrency, args.requests, args.k)
+            results.append(result)
+            print(f"{concurrency:>4} clients  {result['queries_per_second']:8.0f} queries/s  p50/p95/p99 "
+                  f"{result['p50_ms']:.2f}/{result['p95_ms']:.2f}/{result['p99_ms']:.2f} ms  "
+                  f"mean batch {result['mean_batch']:.1f}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
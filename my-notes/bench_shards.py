@@ -0,0 +1,112 @@
+'''
+Benchmark query throughput of the sharded index against the shard count.
+
+    python bench_shards.py                                  # 100k vectors, 1 shard up to one per core
+    python bench_shards.py --size 500000 --shards 1 2 4 8 --json bench-results/shards.json
+
+Random unit vectors are saved once per shard count as an npy32 ShardedIndex,
+then loaded again so every worker searches its memory-mapped shard. For each
+count it measures:
+    load        - seconds to start the workers and map the shards
+    throughput  - queries per second, in batches of --batch queries
+    latency     - p50/p95 ms of single query searches
+    recall      - recall@k against one in-process NumpyIndex over the same vectors
+The in-process row is that NumpyIndex, with numpy using as many BLAS threads
+as it likes. Every worker is limited to one thread, so the speedup over one
+shard can't go past the number of cores.
+'''
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import notes_index
+import sharded_index
+from bench_notes import percentile
+from bench_vectors import make_vectors, make_queries
+
+MODEL_NAME = 'bench-shards'
+
+
+def shard_counts():
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+    return counts
+
+
+def measure(index, queries, k, batch):
+    result = {}
+    latencies = []
+    for query in queries[:100]:
+        started = time.perf_counter()
+        index.search(query.copy(), k)
+        latencies.append(1000 * (time.perf_counter() - started))
+    result['query_p50_ms'] = percentile(latencies, 0.5)
+    result['query_p95_ms'] = percentile(latencies, 0.95)
+
+    hits = []
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch):
+        hits += index.search_many(queries[start:start + batch].copy(), k)
+    result['queries_per_second'] = len(queries) / (time.perf_counter() - started)
+    result['hits'] = [[note_id for note_id, _ in query_hits] for query_hits in hits]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100_000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--shards', type=int, nargs='+', default=shard_counts())
+    parser.add_argument('--queries', type=int, default=1024)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.size, args.dim)
+    queries = make_queries(vectors, args.queries)
+    ids = [str(row) for row in range(len(vectors))]
+    print(f'{args.size} vectors of {args.dim} dimensions, {os.cpu_count()} cores')
+
+    single = notes_index.NumpyIndex(args.dim, MODEL_NAME, kind='npy32')
+    single.add(ids, ids, vectors)
+    baseline = measure(single, queries, args.k, args.batch)
+    exact = baseline.pop('hits')
+    rows = [{'shards': 0, 'load_seconds': 0.0, **baseline}]
+    del single
+
+    for shards in args.shards:
+        workdir = tempfile.mkdtemp(prefix=f'bench-shards-{shards}-')
+        try:
+            index = sharded_index.ShardedIndex(args.dim, MODEL_NAME, shards, 'npy32')
+            index.add(ids, ids, vectors)
+            index.save(workdir)
+            index.close()
+            started = time.perf_counter()
+            index = notes_index.load_index(workdir, MODEL_NAME, shards=shards)
+            row = {'shards': shards, 'load_seconds': time.perf_counter() - started, **measure(index, queries, args.k, args.batch)}
+            index.close()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        found = row.pop('hits')
+        row['recall_at_k'] = sum(len(set(a) & set(b)) for a, b in zip(found, exact)) / (args.k * len(exact))
+        rows.append(row)
+
+    one_shard = next((row['queries_per_second'] for row in rows if row['shards'] == 1), None)
+    for row in rows:
+        name = f"{row['shards']:>3} shards" if row['shards'] else ' in process'
+        speedup = f"  x{row['queries_per_second'] / one_shard:.2f}" if one_shard and row['shards'] else ''
+        recall = f"  recall {row['recall_at_k']:.3f}" if 'recall_at_k' in row else ''
+        print(f"{name}  load {row['load_seconds']:6.2f}s  {row['queries_per_second']:8.0f} queries/s{speedup:7}  "
+              f"query p50/p95 {row['query_p50_ms']:.2f}/{row['query_p95_ms']:.2f} ms{recall}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'size': args.size, 'dim': args.dim, 'cores': os.cpu_count(), 'results': rows}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
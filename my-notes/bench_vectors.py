@@ -0,0 +1,136 @@
+'''
+Benchmark the saved vector stores: faiss flat against the NumPy npy16/npy32 kinds.
+
+    python bench_vectors.py                          # 10k and 50k vectors
+    python bench_vectors.py --sizes 10000 50000 200000 --dim 384 --json bench-results/vectors.json
+
+Random unit vectors are saved once per size with every kind, then a fresh
+process per kind measures what the app pays on a cold start:
+    load     - seconds in notes_index.load_index(), meta.json included, and for
+               the npy kinds the part of it spent mapping vectors.npy
+    rss      - resident MB of that process before loading, after loading and after the queries
+    query    - p50/p95 ms of single query searches, and ms per query in batches of 64
+    recall   - recall@10 against flat
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import notes_index
+from bench_notes import percentile
+
+KINDS = ['flat', 'npy16', 'npy32']
+MODEL_NAME = 'bench-vectors'
+
+
+def rss_mb():
+    with open('/proc/self/statm', 'r') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def make_vectors(size, dim, seed=0):
+    return notes_index.to_matrix(np.random.default_rng(seed).standard_normal((size, dim), dtype='float32'))
+
+
+def make_queries(vectors, count, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), count)]
+    return notes_index.to_matrix(queries + rng.normal(0, 0.05, queries.shape).astype('float32'))
+
+
+def save_kinds(workdir, vectors):
+    ids = [str(row) for row in range(len(vectors))]
+    for kind in KINDS:
+        if kind in notes_index.NUMPY_KINDS:
+            index = notes_index.NumpyIndex(vectors.shape[1], MODEL_NAME, kind=kind)
+        else:
+            index = notes_index.NotesIndex(vectors.shape[1], MODEL_NAME, kind=kind)
+        index.add(ids, ids, vectors)
+        index.save(os.path.join(workdir, kind))
+
+
+def run_kind(kind, args):
+    # Runs in a fresh process so load time and RSS are those of a cold start
+    result = {'kind': kind, 'rss_before_mb': rss_mb()}
+    started = time.perf_counter()
+    index = notes_index.load_index(os.path.join(args.workdir, kind), MODEL_NAME)
+    result['load_seconds'] = time.perf_counter() - started
+    result['rss_loaded_mb'] = rss_mb()
+    # The rest of load_seconds is reading ids and hashes from meta.json, the same for every kind
+    if kind in notes_index.NUMPY_KINDS:
+        started = time.perf_counter()
+        np.load(os.path.join(args.workdir, kind, notes_index.VECTORS_FILENAME), mmap_mode='r')
+        result['map_vectors_seconds'] = time.perf_counter() - started
+
+    queries = make_queries(make_vectors(args.size, args.dim), args.queries)
+    latencies = []
+    hits = []
+    for query in queries:
+        started = time.perf_counter()
+        hits.append(index.search(query.copy(), 10))
+        latencies.append(1000 * (time.perf_counter() - started))
+    result['query_p50_ms'] = percentile(latencies, 0.5)
+    result['query_p95_ms'] = percentile(latencies, 0.95)
+
+    started = time.perf_counter()
+    for start in range(0, len(queries), 64):
+        index.search_many(queries[start:start + 64].copy(), 10)
+    result['batch_ms_per_query'] = 1000 * (time.perf_counter() - started) / len(queries)
+    result['rss_after_mb'] = rss_mb()
+    result['hits'] = [[note_id for note_id, _ in query_hits] for query_hits in hits]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', nargs='?', default='run', choices=['run'] + KINDS, help=argparse.SUPPRESS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if args.mode != 'run':
+        print(json.dumps(run_kind(args.mode, args)))
+        return
+
+    results = []
+    for size in args.sizes:
+        workdir = tempfile.mkdtemp(prefix=f'bench-vectors-{size}-')
+        try:
+            save_kinds(workdir, make_vectors(size, args.dim))
+            rows = []
+            for kind in KINDS:
+                command = [sys.executable, __file__, kind, '--size', str(size), '--dim', str(args.dim),
+                           '--queries', str(args.queries), '--workdir', workdir]
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                rows.append(json.loads(output.strip().splitlines()[-1]))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        exact = rows[0]['hits']
+        for row in rows:
+            found = row.pop('hits')
+            row['recall_at_10'] = sum(len(set(a) & set(b)) for a, b in zip(found, exact)) / (10 * len(exact))
+            row['notes'] = size
+            results.append(row)
+            mapped = f" (map {1000 * row['map_vectors_seconds']:.2f})" if 'map_vectors_seconds' in row else ''
+            print(f"{size:>8} {row['kind']:6} load {1000 * row['load_seconds']:8.1f} ms{mapped:13}  rss {row['rss_before_mb']:5.0f} -> "
+                  f"{row['rss_loaded_mb']:5.0f} -> {row['rss_after_mb']:5.0f} MB  query p50/p95 {row['query_p50_ms']:.2f}/"
+                  f"{row['query_p95_ms']:.2f} ms  batched {row['batch_ms_per_query']:.3f} ms/query  recall {row['recall_at_10']:.3f}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Note bodies in one file, read back through mmap.
+
+The file is only appended to: write() adds bodies at the end and fsyncs, and
+entries maps each note id to [offset, length, compressed] of its newest
+body. Reading a note maps nothing new, it slices the mapped file and
+decompresses, so only the notes that are actually shown are ever read and
+the rest stay on disk (or in the page cache) instead of in the process.
+
+Bodies longer than COMPRESS_MIN bytes are zlib compressed when that makes
+them smaller. Replaced and removed bodies stay in the file as dead bytes
+until rewrite() copies the live ones to a new file.
+'''
+import os
+import mmap
+import zlib
+
+# Shorter bodies are stored as they are, zlib barely helps and costs a call per read
+COMPRESS_MIN = 256
+
+
+class BodyStore:
+    '''Append-only file of note bodies with an in-memory offset index'''
+
+    def __init__(self, path, entries=None, compress=True):
+        self.path = path
+        self.compress = compress
+        self.entries = {note_id: tuple(entry) for note_id, entry in (entries or {}).items()}
+        self.live_bytes = sum(entry[1] for entry in self.entries.values())
+        self.map = None
+        self._map()
+
+    def _map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, note_id):
+        return note_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, note_id):
+        entry = self.entries.get(note_id)
+        if entry is None:
+            return None
+        offset, length, compressed = entry
+        data = self.map[offset:offset + length]
+        return (zlib.decompress(data) if compressed else data).decode('utf-8')
+
+    def file_bytes(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def dead_ratio(self):
+        size = self.file_bytes()
+        return 1 - self.live_bytes / size if size else 0.0
+
+    def write(self, notes):
+        # notes is {note_id: text}, appended in one write and fsync
+        chunks = []
+        entries = {}
+        offset = self.file_bytes()
+        for note_id, text in notes.items():
+            data = text.encode('utf-8')
+            compressed = False
+            if self.compress and len(data) > COMPRESS_MIN:
+                packed = zlib.compress(data, 6)
+                if len(packed) < len(data):
+                    data, compressed = packed, True
+            entries[note_id] = (offset, len(data), compressed)
+            chunks.append(data)
+            offset += len(data)
+        with open(self.path, 'ab') as file:
+            file.write(b''.join(chunks))
+            file.flush()
+            os.fsync(file.fileno())
+        for note_id, entry in entries.items():
+            self.remove(note_id)
+            self.entries[note_id] = entry
+            self.live_bytes += entry[1]
+        self._map()
+
+    def remove(self, note_id):
+        entry = self.entries.pop(note_id, None)
+        if entry is not None:
+            self.live_bytes -= entry[1]
+
+    def rewrite(self, path):
+        # Copies the live bodies, still compressed, to a new file and returns a store over it
+        entries = {}
+        offset = 0
+        with open(path, 'wb') as file:
+            for note_id, (start, length, compressed) in self.entries.items():
+                file.write(self.map[start:start + length])
+                entries[note_id] = (offset, length, compressed)
+                offset += length
+            file.flush()
+            os.fsync(file.fileno())
+        return BodyStore(path, entries, self.compress)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,144 @@
+'''
+Build the notes index with a given kind and compare index kinds.
+
+    python build_index.py --kind hnsw                  # rebuild my-notes-index as HNSW
+    python build_index.py --kind npy32 --shards 4      # rebuild it as 4 shards, see sharded_index.py
+    python build_index.py --report                     # recall vs latency of every kind against flat
+    python build_index.py --report --json report.json --queries 500 --k 10
+
+The report uses the stored notes' vectors (from the embedding cache) as the
+corpus and lightly perturbed copies of some of them as queries. Recall@k is
+measured against exact flat search over the same vectors.
+'''
+import sys
+import time
+import json
+import argparse
+
+import numpy as np
+
+import config
+import notes_index
+import note_log
+import warm_model
+from embedding_cache import EmbeddingCache
+
+# Search time settings tried per kind, keyword arguments for set_search_params
+SEARCH_SETTINGS = {
+    'flat': [{}],
+    'sq8': [{}],
+    'hnsw': [{'ef_search': ef} for ef in (16, 32, 64, 128, 256)],
+    'ivfpq': [{'nprobe': nprobe, 'k_factor': k_factor} for nprobe in (4, 16, 64) for k_factor in (2, 8)],
+    'npy16': [{}],
+    'npy32': [{}],
+}
+
+
+def open_embeddings(read_only=False):
+    model = warm_model.get_model(config.EMBEDDING_MODEL_NAME)
+    return EmbeddingCache(model, config.EMBEDDING_MODEL_NAME, config.EMBEDDINGS_DIR, read_only)
+
+
+def make_queries(matrix, count, noise=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.choice(len(matrix), min(count, len(matrix)), replace=False)]
+    return notes_index.to_matrix(queries + rng.normal(0, noise, queries.shape).astype('float32'))
+
+
+def recall_report(matrix, queries, k=10, kinds=notes_index.INDEX_KINDS):
+    # Returns one row per (kind, search setting) with build time, recall@k and latency.
+    # Kinds that can not be trained on this few vectors are left out
+    matrix = notes_index.to_matrix(matrix)
+    k = min(k, len(matrix))
+    exact = notes_index.make_faiss_index('flat', matrix.shape[1], len(matrix))
+    exact.add(matrix)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for kind in kinds:
+        if not notes_index.can_train(kind, len(matrix)):
+            continue
+        started = time.perf_counter()
+        if kind in notes_index.NUMPY_KINDS:
+            index = matrix.astype(notes_index.NUMPY_KINDS[kind])
+        else:
+            index = notes_index.make_faiss_index(kind, matrix.shape[1], len(matrix))
+            notes_index.train(index, matrix)
+            index.add(matrix)
+        build_seconds = time.perf_counter() - started
+
+        for settings in SEARCH_SETTINGS[kind]:
+            started = time.perf_counter()
+            if kind in notes_index.NUMPY_KINDS:
+                _, found = notes_index.exact_top_k([index], queries, k)
+            else:
+                notes_index.set_search_params(index, **settings)
+                _, found = index.search(queries, k)
+            search_seconds = time.perf_counter() - started
+            hits = sum(len(set(found[row]) & set(truth[row])) for row in range(len(queries)))
+            rows.append({
+                'kind': kind,
+                'settings': settings,
+                'build_seconds': round(build_seconds, 4),
+                f'recall_at_{k}': round(hits / (k * len(queries)), 4),
+                'ms_per_query': round(1000 * search_seconds / len(queries), 4),
+                'index_bytes': faiss_index_size(index),
+            })
+    return rows
+
+
+def faiss_index_size(index):
+    if isinstance(index, np.ndarray):
+        return index.nbytes
+    return int(notes_index.faiss.serialize_index(index).size)
+
+
+def print_report(rows):
+    for row in rows:
+        recall = next(value for name, value in row.items() if name.startswith('recall_at_'))
+        settings = ' '.join(f'{name}={value}' for name, value in row['settings'].items())
+        print(f"{row['kind']:6} {settings:22} recall {recall:.3f}  {row['ms_per_query']:8.3f} ms/query  "
+              f"build {row['build_seconds']:.2f}s  {row['index_bytes'] / 2**20:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', choices=notes_index.INDEX_KINDS, help='rebuild the saved index with this kind')
+    parser.add_argument('--shards', type=int, default=config.SHARDS, help='split the rebuilt index over this many shards')
+    parser.add_argument('--report', action='store_true', help='compare recall and latency of every kind')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    # Rebuilding writes the index and the embedding cache the app writes too, so it takes the note log's lock.
+    # The report alone writes neither and runs next to the app
+    try:
+        log = note_log.open_notes(config.NOTES_FILEPATH, config.NOTES_LOG_FILEPATH, config.NOTES_SNAPSHOT_FILEPATH,
+                                  read_only=not args.kind)
+    except note_log.NoteLogLocked as error:
+        sys.exit(f'{error}\nStop it before rebuilding the index')
+    notes = log.copy_notes()
+    embeddings = open_embeddings(read_only=not args.kind)
+
+    if args.kind:
+        started = time.perf_counter()
+        index = notes_index.build_index(notes, embeddings, config.EMBEDDING_MODEL_NAME, args.kind, config.PASSAGES, args.shards)
+        index.save(config.INDEX_DIR)
+        shards = f' in {args.shards} shards' if args.shards else ''
+        print(f'built {args.kind} index{shards} over {len(index)} notes in {time.perf_counter() - started:.2f}s')
+
+    if args.report:
+        matrix = np.asarray(embeddings.embed_documents(list(notes.values())))
+        rows = recall_report(matrix, make_queries(matrix, args.queries), args.k)
+        print_report(rows)
+        skipped = [kind for kind in notes_index.INDEX_KINDS if not notes_index.can_train(kind, len(matrix))]
+        if skipped:
+            print(f"skipped {', '.join(skipped)}: too few notes to train on")
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(rows, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+'''
+First import of a large archive of notes, embedded by several processes.
+
+    python bulk_import.py ~/archive                      # every .md/.txt file under it is a note
+    python bulk_import.py notes.jsonl --workers 4 --threads 2
+    python bulk_import.py ~/archive export.jsonl --batch-size 512
+
+Inputs are folders (each .md/.txt file is a note, read like watch_folder.py
+does), .jsonl files with one {"text": ...} per line, or single .md/.txt
+files. They are read as a stream and added to the note log a chunk at a
+time, text that is already a note is skipped.
+
+Then every note (or passage, with PASSAGES) that has no vector in the
+embedding cache yet is embedded. The texts are sorted by length so each
+batch pads to about the same length, and the batches go to a pool of
+--workers processes, each loading the model once and using --threads
+threads. Every finished batch is appended to the embedding cache, which is
+fsynced, so an interrupted import loses at most the batches in flight:
+running the same command again skips the notes already in the note log and
+the vectors already in the cache. Finally the vector index is loaded or
+built from the cache, without embedding anything again, and saved.
+
+Progress is printed every few seconds with texts per second and time left.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import config
+import note_log
+import notes_index
+import passages as note_passages
+import embedders
+import warm_model
+import watch_folder
+from embedding_cache import EmbeddingCache
+
+# Notes per note log commit while reading the inputs
+ADD_CHUNK = 1000
+PROGRESS_SECONDS = 5
+
+# The model of this worker process, and how to load it
+_model = None
+_loader = None
+
+
+def read_inputs(paths):
+    # Yields note texts, one input at a time
+    for path in paths:
+        if os.path.isdir(path):
+            for _, _, text in watch_folder.read_files(path, watch_folder.scan_folder(path)):
+                yield text
+        elif path.endswith('.jsonl'):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)['text']
+        else:
+            with open(path, 'rb') as file:
+                yield watch_folder.parse_note(file.read())
+
+
+def import_notes(log, texts):
+    # Returns (notes added, notes already there)
+    added = existing = 0
+    for chunk in watch_folder.batches((text for text in texts if text.strip()), ADD_CHUNK):
+        for _, created in log.add_many(chunk, source='file'):
+            added += created
+            existing += not created
+    return added, existing
+
+
+def embedding_texts(notes, passages):
+    # The texts the index embeds, whole notes or their passages
+    if not passages:
+        return list(notes.values())
+    return [text[start:end] for text in notes.values() for start, end in note_passages.split_passages(text)]
+
+
+def length_batches(texts, batch_size):
+    # Similar lengths batched together, so the model pads every batch to about its own length
+    return list(watch_folder.batches(sorted(texts, key=len), batch_size))
+
+
+def start_worker(loader, model_name):
+    global _loader
+    _loader = (loader, model_name)
+
+
+def embed_batch(texts):
+    # The model loads on the first batch, so a model that fails to load fails the import instead of restarting workers
+    global _model
+    if _model is None:
+        loader, model_name = _loader
+        _model = loader(model_name, {})
+    return texts, np.asarray(_model.embed_documents(texts), dtype='float32')
+
+
+def embed_missing(embeddings, texts, loader, workers, threads, batch_size, progress=print):
+    # Embeds the texts that aren't cached yet and appends them to the cache batch by batch, returns how many
+    missing = embeddings.missing(texts)
+    if not missing:
+        return 0
+    batches = length_batches(missing, batch_size)
+    done = 0
+    started = last_report = time.perf_counter()
+    # spawn, so every worker imports torch itself with the thread count set here
+    with warm_model.pinned_threads(threads):
+        pool = multiprocessing.get_context('spawn').Pool(workers, start_worker, (loader, embeddings.model_name))
+    with pool:
+        for batch, vectors in pool.imap_unordered(embed_batch, batches):
+            embeddings.store(batch, vectors)
+            done += len(batch)
+            now = time.perf_counter()
+            if now - last_report > PROGRESS_SECONDS or done == len(missing):
+                last_report = now
+                rate = done / (now - started)
+                progress(f'embedded {done}/{len(missing)}  {rate:.1f} texts/s  {(len(missing) - done) / rate:.0f}s left')
+    return len(missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='folders, .jsonl files or .md/.txt files')
+    parser.add_argument('--workers', type=int, default=max(1, os.cpu_count() // 2))
+    parser.add_argument('--threads', type=int, default=2, help='torch/BLAS threads per worker')
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+    for path in args.inputs:
+        if not os.path.exists(path):
+            sys.exit(f'{path} does not exist')
+
+    started = time.perf_counter()
+    try:
+        log = note_log.open_notes(config.NOTES_FILEPATH, config.NOTES_LOG_FILEPATH, config.NOTES_SNAPSHOT_FILEPATH)
+    except note_log.NoteLogLocked as error:
+        sys.exit(str(error))
+    added, existing = import_notes(log, read_inputs(args.inputs))
+    print(f'{added} notes added, {existing} already there, {time.perf_counter() - started:.1f}s')
+    log.maybe_compact()
+
+    notes = log.copy_notes()
+    # The pool does the embedding, this process only needs the cache. The model is loaded if anything is left over
+    embeddings = EmbeddingCache(warm_model.WarmModel(config.EMBEDDING_MODEL_NAME), config.EMBEDDING_MODEL_NAME, config.EMBEDDINGS_DIR)
+    embed_started = time.perf_counter()
+    embedded = embed_missing(embeddings, embedding_texts(notes, config.PASSAGES), embedders.load_backend, args.workers,
+                             args.threads, args.batch_size)
+    if embedded:
+        print(f'embedded {embedded} texts with {args.workers} workers in {time.perf_counter() - embed_started:.1f}s')
+
+    index_started = time.perf_counter()
+    index = notes_index.load_or_build(notes, embeddings, config.INDEX_DIR, config.EMBEDDING_MODEL_NAME, config.INDEX_KIND,
+                                      config.PASSAGES, config.SHARDS)
+    print(f'index of {len(index) if index is not None else 0} notes saved in {time.perf_counter() - index_started:.1f}s')
+    seconds = time.perf_counter() - started
+    print(f'{len(notes)} notes in {seconds:.1f}s, {len(notes) / seconds:.1f} notes/s')
+    log.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+'''
+File locations and model settings shared by the notes app and the command line tools.
+
+Paths are relative, run everything from the my-notes directory.
+'''
+NOTES_FILEPATH = 'my-notes.json'
+NOTES_LOG_FILEPATH = 'my-notes.log'
+NOTES_SNAPSHOT_FILEPATH = 'my-notes.snapshot.json'
+# Note bodies file, see body_store.py, numbered per rewrite
+NOTES_BODIES_FILEPATH = 'my-notes.bodies'
+COMPRESS_NOTES = True
+INDEX_DIR = 'my-notes-index'
+EMBEDDINGS_DIR = 'my-notes-embeddings'
+# Also picks the embedding backend: "int8:" in front quantizes the model, "hashing-384" needs no model, see embedders.py
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# None picks flat/hnsw/ivfpq from the number of notes, see notes_index.py
+INDEX_KIND = None
+# Index passages of notes rather than whole notes, see passages.py
+PASSAGES = True
+# Split the vector index over this many worker processes, see sharded_index.py. None keeps one index in process
+SHARDS = None
+# Folder of .md/.txt files the app keeps in the notes store, see watch_folder.py. None turns it off
+WATCH_FOLDER = None
+WATCH_POLL_SECONDS = 5
+WATCH_CHECKPOINT_FILEPATH = 'my-notes.watch.json'
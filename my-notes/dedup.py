@@ -0,0 +1,99 @@
+'''
+Duplicate detection for note ingest.
+
+content_hash() is the identity of a note: two notes that only differ in
+surrounding or repeated whitespace hash the same, so ingesting the same text
+twice is a no-op.
+
+NearDuplicateIndex finds lightly edited copies with 64 bit SimHash over word
+3-grams. The fingerprint is split into 4 bands of 16 bits and notes sharing a
+band are compared, which finds every note within 3 differing bits without
+scanning the corpus.
+'''
+import re
+import hashlib
+import threading
+
+SIMHASH_BITS = 64
+BANDS = 4
+BAND_BITS = SIMHASH_BITS // BANDS
+MAX_DISTANCE = 3
+
+WHITESPACE = re.compile(r'\s+')
+WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def content_hash(text):
+    return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+
+
+def simhash(text):
+    words = WORD.findall(text.lower())
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def bands(fingerprint):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, fingerprint >> (band * BAND_BITS) & mask) for band in range(BANDS)]
+
+
+class NearDuplicateIndex:
+    def __init__(self, max_distance=MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.fingerprints = {}
+        self.buckets = {}
+        # The folder watcher adds notes from its own thread while page runs call find()
+        self.lock = threading.Lock()
+
+    def add(self, note_id, text):
+        fingerprint = simhash(text)
+        with self.lock:
+            self._discard(note_id)
+            self.fingerprints[note_id] = fingerprint
+            for key in bands(fingerprint):
+                self.buckets.setdefault(key, set()).add(note_id)
+
+    def remove(self, note_id):
+        with self.lock:
+            self._discard(note_id)
+
+    def _discard(self, note_id):
+        # Caller holds self.lock. An edited note leaves none of its old bands behind
+        fingerprint = self.fingerprints.pop(note_id, None)
+        if fingerprint is None:
+            return
+        for key in bands(fingerprint):
+            self.buckets.get(key, set()).discard(note_id)
+
+    def find(self, text):
+        # Returns (note_id, distance) of the closest near duplicate, or None
+        fingerprint = simhash(text)
+        best = None
+        with self.lock:
+            for key in bands(fingerprint):
+                for note_id in self.buckets.get(key, ()):
+                    distance = hamming(fingerprint, self.fingerprints[note_id])
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (note_id, distance)
+        return best
+
+
+def build_near_duplicate_index(notes):
+    index = NearDuplicateIndex()
+    for note_id, text in notes.items():
+        index.add(note_id, text)
+    return index
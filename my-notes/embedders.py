@@ -0,0 +1,165 @@
+'''
+Embedding backends, picked by the model name in config.py.
+
+    sentence-transformers/all-MiniLM-L6-v2       HuggingFaceBackend, langchain's HuggingFaceEmbeddings on torch
+    int8:sentence-transformers/all-MiniLM-L6-v2  QuantizedBackend, the same model with its linear layers
+                                                 quantized to int8 for CPU, needs torch and sentence-transformers
+    hashing-384                                  HashingEmbeddings, no model and nothing beyond numpy
+
+load_backend() builds one from its name. Every backend has
+embed_documents()/embed_query(), its output dimension in dim and stats()
+with the number of texts embedded and texts per second. The model name is
+what the embedding cache is keyed by and what the index saves in its meta,
+so vectors of different backends never end up in one store: each name has
+its own cache directory, an index of another name is rebuilt on load, and
+an index or cache handed an embedder of another name or dimension raises
+ValueError.
+
+HashingEmbeddings maps each lowercased token and token bigram to a signed
+bucket of a fixed size vector (the hashing trick) and L2 normalizes it. It
+is deterministic and embeds thousands of notes a second, so tests,
+benchmarks and offline runs can exercise the whole pipeline without
+loading a model.
+
+    python embedders.py hashing-384 sentence-transformers/all-MiniLM-L6-v2   # dimension and throughput of each
+'''
+import re
+import abc
+import sys
+import time
+import zlib
+import threading
+
+import numpy as np
+
+TOKEN = re.compile(r'\w+')
+HASHING_NAME = re.compile(r'hashing-(\d+)$')
+QUANTIZED_PREFIX = 'int8:'
+
+
+class EmbeddingBackend(abc.ABC):
+    '''embed_documents()/embed_query() over _embed(), counting texts and seconds'''
+
+    def __init__(self, model_name, dim=None):
+        self.model_name = model_name
+        self.dim = dim
+        self.texts = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _embed(self, texts):
+        # A list or array of one vector per text
+        ...
+
+    def embed_documents(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype='float32')
+        started = time.perf_counter()
+        matrix = np.asarray(self._embed(list(texts)), dtype='float32').reshape(len(texts), -1)
+        with self.lock:
+            self.texts += len(texts)
+            self.seconds += time.perf_counter() - started
+        return matrix
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        with self.lock:
+            return {'model_name': self.model_name, 'dim': self.dim, 'texts': self.texts,
+                    'texts_per_second': self.texts / self.seconds if self.seconds else 0.0}
+
+
+class HashingEmbeddings(EmbeddingBackend):
+    def __init__(self, dim=384):
+        super().__init__(f'hashing-{dim}', dim)
+
+    def _bucket(self, feature):
+        # Signed bucket as one int, +index+1 or -(index+1). Not memoized: a crc32 costs about a dict lookup,
+        # and a memo of every token and bigram would grow with the corpus
+        value = zlib.crc32(feature.encode('utf-8'))
+        return (value % self.dim + 1) * (1 if value >> 31 else -1)
+
+    def embed(self, text):
+        tokens = TOKEN.findall(text.lower())
+        buckets = np.fromiter(map(self._bucket, tokens + [a + ' ' + b for a, b in zip(tokens, tokens[1:])]), dtype='int64')
+        vector = np.bincount(np.abs(buckets) - 1, weights=np.sign(buckets), minlength=self.dim).astype('float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _embed(self, texts):
+        return [self.embed(text) for text in texts]
+
+
+class HuggingFaceBackend(EmbeddingBackend):
+    def __init__(self, model_name, timings):
+        super().__init__(model_name)
+        started = time.perf_counter()
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        timings['import_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        self.model = HuggingFaceEmbeddings(model_name=model_name)
+        timings['load_seconds'] = time.perf_counter() - started
+
+        # The first call is much slower than the rest, pay for it here instead of on the first query
+        started = time.perf_counter()
+        self.dim = len(self.model.embed_query('warm up'))
+        timings['first_embed_seconds'] = time.perf_counter() - started
+
+    def _embed(self, texts):
+        return self.model.embed_documents(texts)
+
+
+class QuantizedBackend(EmbeddingBackend):
+    '''A sentence-transformers model with dynamically quantized int8 linear layers, about twice as fast on CPU'''
+
+    def __init__(self, model_name, timings, batch_size=64):
+        super().__init__(model_name)
+        self.batch_size = batch_size
+        started = time.perf_counter()
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as error:
+            raise ImportError(f'{model_name} needs torch and sentence-transformers installed') from error
+        timings['import_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        model = SentenceTransformer(model_name[len(QUANTIZED_PREFIX):], device='cpu')
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        timings['load_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        self.dim = len(self._embed(['warm up'])[0])
+        timings['first_embed_seconds'] = time.perf_counter() - started
+
+    def _embed(self, texts):
+        return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False)
+
+
+def load_backend(model_name, timings=None):
+    # timings gets import/load/first embed seconds of the backends that load a model
+    timings = {} if timings is None else timings
+    match = HASHING_NAME.match(model_name)
+    if match:
+        return HashingEmbeddings(int(match.group(1)))
+    if model_name.startswith(QUANTIZED_PREFIX):
+        return QuantizedBackend(model_name, timings)
+    return HuggingFaceBackend(model_name, timings)
+
+
+if __name__ == '__main__':
+    import synthetic_notes
+
+    texts = list(synthetic_notes.generate_notes(500))
+    for name in sys.argv[1:] or ['hashing-384']:
+        timings = {}
+        started = time.perf_counter()
+        backend = load_backend(name, timings)
+        loaded = time.perf_counter() - started
+        for start in range(0, len(texts), 64):
+            backend.embed_documents(texts[start:start + 64])
+        stats = backend.stats()
+        print(f"{name}: {stats['dim']} dimensions, loaded in {loaded:.2f}s, {stats['texts_per_second']:.0f} texts/s")
@@ -0,0 +1,166 @@
+'''
+On-disk embedding cache keyed by (model name, note content hash).
+
+Each model gets its own directory under the cache dir so switching the
+embedding model only invalidates that model's entries:
+    meta.json    - model name and dimension
+    vectors.f32  - float32 matrix, one row per cached note, memory mapped for reads
+    hashes.txt   - content hash of each row, one per line, row i is line i
+
+Both files are only ever appended to. The vector row is written before its
+hash, so after a crash the files are trimmed back to the rows that have both.
+
+Rows are numbered by the process that appends them, so only one process may
+write a cache directory: the one holding the note log's lock (see
+note_log.py). Tools that run next to it open the cache with read_only=True,
+they read the rows there were when they opened it and embed anything else
+with the model without storing it.
+'''
+import os
+import re
+import json
+import threading
+
+import numpy as np
+
+from notes_index import note_hash
+
+
+def model_dirname(model_name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+
+
+class EmbeddingCache:
+    '''Wraps an embeddings model, embed_documents() only embeds notes it has not seen before'''
+
+    def __init__(self, embeddings, model_name, cache_dir, read_only=False):
+        # The cache of one model name must never hold another backend's vectors, see embedders.py
+        if getattr(embeddings, 'model_name', model_name) != model_name:
+            raise ValueError(f'Embedding cache for {model_name} can not wrap {embeddings.model_name}')
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.read_only = read_only
+        self.dir = os.path.join(cache_dir, model_dirname(model_name))
+        self.vectors_path = os.path.join(self.dir, 'vectors.f32')
+        self.hashes_path = os.path.join(self.dir, 'hashes.txt')
+        self.rows = {}
+        self.dim = None
+        self.matrix = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        if not self.read_only:
+            os.makedirs(self.dir, exist_ok=True)
+        try:
+            with open(os.path.join(self.dir, 'meta.json'), 'r') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return
+        if meta.get('model_name') != self.model_name:
+            return
+        self.dim = meta['dim']
+
+        try:
+            with open(self.hashes_path, 'r') as file:
+                content = file.read()
+        except OSError:
+            content = ''
+        # A hash line without its newline was cut off mid write
+        hashes = content.split('\n')[:-1]
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        count = min(len(hashes), size // (4 * self.dim))
+
+        # Read only, rows past count may be the writer's append in progress and are left alone
+        if not self.read_only and (count != len(hashes) or not content.endswith('\n')):
+            with open(self.hashes_path, 'w') as file:
+                file.write(''.join(item + '\n' for item in hashes[:count]))
+        if not self.read_only and size != count * 4 * self.dim:
+            with open(self.vectors_path, 'ab') as file:
+                file.truncate(count * 4 * self.dim)
+
+        self.rows = {item: row for row, item in enumerate(hashes[:count])}
+        self._map()
+
+    def _map(self):
+        if self.rows:
+            self.matrix = np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(len(self.rows), self.dim))
+
+    def _append(self, hashes, vectors):
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype='float32'))
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f'Embedding cache of {self.dim} dimensional vectors can not take {vectors.shape[1]} dimensional ones')
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(os.path.join(self.dir, 'meta.json'), 'w') as file:
+                json.dump({'model_name': self.model_name, 'dim': self.dim}, file)
+            open(self.hashes_path, 'w').close()
+            open(self.vectors_path, 'wb').close()
+
+        with open(self.vectors_path, 'ab') as file:
+            file.write(vectors.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        with open(self.hashes_path, 'a') as file:
+            file.write(''.join(item + '\n' for item in hashes))
+        for item in hashes:
+            self.rows[item] = len(self.rows)
+        self._map()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype='float32')
+        hashes = [note_hash(text) for text in texts]
+        with self.lock:
+            missing = {}
+            for item, text in zip(hashes, texts):
+                if item not in self.rows and item not in missing:
+                    missing[item] = text
+            self.misses += len(missing)
+            self.hits += len(hashes) - len(missing)
+            if not missing:
+                return np.array(self.matrix[[self.rows[item] for item in hashes]])
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            if not self.read_only:
+                self._append(list(missing), vectors)
+                return np.array(self.matrix[[self.rows[item] for item in hashes]])
+            fresh = dict(zip(missing, np.asarray(vectors, dtype='float32')))
+            return np.array([fresh[item] if item in fresh else self.matrix[self.rows[item]] for item in hashes], dtype='float32')
+
+    def missing(self, texts):
+        # Texts with no cached vector, each once
+        with self.lock:
+            missing = {}
+            for text in texts:
+                item = note_hash(text)
+                if item not in self.rows and item not in missing:
+                    missing[item] = text
+            return list(missing.values())
+
+    def store(self, texts, vectors):
+        # Vectors embedded somewhere else, e.g. by the bulk_import.py worker processes
+        if self.read_only:
+            raise ValueError(f'Embedding cache {self.dir} was opened read only')
+        hashes = [note_hash(text) for text in texts]
+        with self.lock:
+            new = {}
+            for row, item in enumerate(hashes):
+                if item not in self.rows and item not in new:
+                    new[item] = row
+            if new:
+                self._append(list(new), np.asarray(vectors, dtype='float32')[list(new.values())])
+
+    def embed_query(self, text):
+        # Queries are not notes, they go straight to the model
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts):
+        # A batch of queries in one model call, not cached either
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype='float32')
+        return np.asarray(self.embeddings.embed_documents(texts), dtype='float32')
+
+    def stats(self):
+        return {'model_name': self.model_name, 'entries': len(self.rows), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,181 @@
+'''
+Background indexing of new and edited notes.
+
+Adding a note to the note log is a quick append, embedding it and updating
+the vector index is not. The page hands new notes to an IngestWorker and
+returns straight away; a daemon thread takes them off a bounded queue in
+batches, embeds each batch with one embed_documents() call, adds it to the
+keyword and vector indexes and saves the vector index once per batch.
+
+An edited note is submitted the same way and only that note is embedded
+again (with passages, only its passages that changed), its old rows become
+tombstones. delete() tombstones a note in both
+indexes at once, and queues the delete so a note still waiting to be indexed
+is dropped. After each batch the worker rebuilds the vector index once too
+many of its rows are tombstones, and compacts the note log once it has too
+many dead records, so an edit costs about the same as an add.
+
+Queries keep using the index as it was until a batch is added in one
+NotesIndex.add() call, so they never see part of a batch. The first note of
+an empty store builds a new index, which replaces worker.index only once it
+is complete. worker.generation goes up after every batch and every delete,
+query results cached under an older generation are stale.
+'''
+import time
+import queue
+import threading
+
+import notes_index
+
+
+class IngestWorker:
+    '''Embeds and indexes notes that are already in the note log, on a background thread'''
+
+    def __init__(self, lexical_index, index, embeddings, index_dir, model_name, kind=None, note_log=None, passages=False,
+                 shards=None, max_queue=1000, batch_size=64, linger_seconds=0.05, retry_seconds=5):
+        self.note_log = note_log
+        self.lexical_index = lexical_index
+        self.index = index
+        self.embeddings = embeddings
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.kind = kind
+        self.passages = passages
+        self.shards = shards
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.retry_seconds = retry_seconds
+        self.queue = queue.Queue(max_queue)
+        # {note_id: time it was queued} of notes not yet searchable
+        self.waiting = {}
+        self.indexed = 0
+        self.batches = 0
+        self.compactions = 0
+        self.generation = 0
+        self.last_batch = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='ingest', daemon=True)
+            self.thread.start()
+        return self
+
+    def submit(self, note_id, text, timeout=1):
+        # Raises queue.Full when the worker is too far behind
+        self.start()
+        with self.lock:
+            self.waiting[note_id] = time.time()
+        try:
+            self.queue.put((note_id, text), timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                self.waiting.pop(note_id, None)
+            raise
+
+    def delete(self, note_id, timeout=1):
+        # Searches stop returning the note straight away
+        index = self.index
+        if index is not None:
+            index.remove(note_id)
+        self.lexical_index.remove(note_id)
+        self.start()
+        with self.lock:
+            self.generation += 1
+            self.waiting.setdefault(note_id, time.time())
+        self.queue.put((note_id, None), timeout=timeout)
+
+    def depth(self):
+        with self.lock:
+            return len(self.waiting)
+
+    def lag_seconds(self):
+        # How long the oldest note still waiting has been waiting
+        with self.lock:
+            return time.time() - min(self.waiting.values()) if self.waiting else 0.0
+
+    def join(self, timeout=None):
+        # Waits until everything submitted so far is searchable, returns False on timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while self.depth():
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        with self.lock:
+            waiting = len(self.waiting)
+            lag = time.time() - min(self.waiting.values()) if self.waiting else 0.0
+        index = self.index
+        return {'waiting': waiting, 'lag_seconds': lag, 'indexed': self.indexed, 'batches': self.batches,
+                'last_batch': self.last_batch, 'error': self.error, 'compactions': self.compactions, 'generation': self.generation,
+                'tombstone_ratio': index.tombstone_ratio() if index is not None else 0.0}
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Give a burst of notes a moment to arrive so they are embedded together
+            deadline = time.perf_counter() + self.linger_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    self._index(batch)
+                    self.error = None
+                    break
+                except Exception as error:
+                    # Most likely the model failed to load, keep the batch and try again
+                    self.error = error
+                    time.sleep(self.retry_seconds)
+
+    def _index(self, batch):
+        started = time.perf_counter()
+        # Items are (note_id, text) to add or update and (note_id, None) to delete, in the order they came
+        notes = {}
+        deleted = []
+        for note_id, text in batch:
+            if text is None:
+                notes.pop(note_id, None)
+                deleted.append(note_id)
+            else:
+                notes[note_id] = text
+        index = self.index
+        if notes and index is None:
+            index = notes_index.build_index(notes, self.embeddings, self.model_name, self.kind, self.passages, self.shards)
+        elif notes:
+            index.upsert(notes, self.embeddings)
+        for note_id, text in notes.items():
+            self.lexical_index.add(note_id, text)
+        # Again, in case the note was being indexed when delete() ran
+        for note_id in deleted:
+            if index is not None:
+                index.remove(note_id)
+            self.lexical_index.remove(note_id)
+        self.index = index
+        self._compact()
+        if self.index is not None:
+            self.index.save(self.index_dir)
+
+        finished = time.time()
+        with self.lock:
+            queued = [self.waiting.pop(note_id) for note_id, _ in batch if note_id in self.waiting]
+            self.indexed += len(notes)
+            self.batches += 1
+            self.generation += 1
+            self.last_batch = {'notes': len(notes), 'seconds': time.perf_counter() - started,
+                               'lag_seconds': finished - min(queued) if queued else 0.0}
+
+    def _compact(self):
+        if self.note_log is None:
+            return
+        if self.index is not None and notes_index.needs_compaction(self.index):
+            # Queries use the old index until the new one is complete, deletes queued meanwhile are applied next batch
+            self.index = notes_index.compact_index(self.index, self.note_log.copy_notes(), self.embeddings)
+            self.compactions += 1
+        self.note_log.maybe_compact()
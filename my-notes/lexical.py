@@ -0,0 +1,123 @@
+'''
+BM25 keyword index over my notes.
+
+Embeddings are bad at exact identifiers like GBQDataRetriever,
+maximum_bytes_billed or REFRESH MATERIALIZED VIEW. This inverted index
+scores notes on the literal tokens instead. Identifiers are kept whole
+(lowercased), so maximum_bytes_billed is one term and not three.
+
+Adding a note only touches that note's postings, nothing is rebuilt.
+'''
+import re
+import math
+import heapq
+import threading
+from collections import Counter
+
+TOKEN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+')
+# Identifier looking tokens: snake_case, camelCase/PascalCase, ALLCAPS or containing digits
+IDENTIFIER = re.compile(r'.*_.*|.*[a-z][A-Z].*|[A-Z]{2,}|.*\d.*')
+
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN.findall(text)]
+
+
+class BM25Index:
+    def __init__(self):
+        self.postings = {}
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self.norms = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, note_id, text):
+        counts = Counter(tokenize(text))
+        with self.lock:
+            if note_id in self.doc_lengths:
+                self._remove(note_id)
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[note_id] = count
+            self.doc_terms[note_id] = list(counts)
+            self.doc_lengths[note_id] = sum(counts.values())
+            self.total_length += self.doc_lengths[note_id]
+            self.norms = None
+
+    def remove(self, note_id):
+        with self.lock:
+            self._remove(note_id)
+
+    def _remove(self, note_id):
+        length = self.doc_lengths.pop(note_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        self.norms = None
+        for term in self.doc_terms.pop(note_id):
+            del self.postings[term][note_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def has_terms(self, terms):
+        return all(term in self.postings for term in terms)
+
+    def _norms(self):
+        # Caller holds self.lock. Length norm of every note, recomputed only after notes change
+        if self.norms is None:
+            average_length = self.total_length / len(self.doc_lengths)
+            self.norms = {note_id: K1 * (1 - B + B * length / average_length) for note_id, length in self.doc_lengths.items()}
+        return self.norms
+
+    def search(self, query, k=4, allowed=None):
+        # Returns [(note_id, score), ...] best first, only notes in allowed when it is given
+        terms = set(tokenize(query))
+        scores = {}
+        with self.lock:
+            count = len(self.doc_lengths)
+            if not count:
+                return []
+            norms = self._norms()
+            for term in terms:
+                notes = self.postings.get(term)
+                if not notes:
+                    continue
+                idf = math.log(1 + (count - len(notes) + 0.5) / (len(notes) + 0.5))
+                for note_id, frequency in notes.items():
+                    if allowed is not None and note_id not in allowed:
+                        continue
+                    scores[note_id] = scores.get(note_id, 0.0) + idf * frequency * (K1 + 1) / (frequency + norms[note_id])
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def build_lexical_index(notes):
+    index = BM25Index()
+    for note_id, text in notes.items():
+        index.add(note_id, text)
+    return index
+
+
+def is_keyword_query(query, index):
+    # "quoted" queries, or queries made only of identifiers the index knows, don't need embeddings
+    query = query.strip()
+    if len(query) > 2 and query[0] == query[-1] == '"':
+        return True
+    words = TOKEN.findall(query)
+    if not words or len(words) > 4 or len(words) != len(query.split()):
+        return False
+    return all(IDENTIFIER.fullmatch(word) for word in words) and index.has_terms(tokenize(query))
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    # rankings is a list of [(note_id, score), ...] lists, returns one fused ranking
+    scores = {}
+    for ranking in rankings:
+        for rank, (note_id, _) in enumerate(ranking):
+            scores[note_id] = scores.get(note_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
@@ -6,100 +6,383 @@ Adding notes as a multi-line string to a list in a .txt file
 and ingesting all notes 
 
 until the bug is fixed 
+
+Notes can also be kept as .md/.txt files in a folder, see watch_folder.py
+
+Queries can be narrowed to notes with given #tags, sources or created dates,
+see note_filters.py
 '''
-import re
-import json
+import time
+import queue
+import datetime
 import streamlit as st 
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+import notes_index
+import note_log
+import dedup
+import lexical
+import retrieval
+import warm_model
+import timing
+import formatter
+import ingest
+import note_browser
+import passages
+import query_cache
+import watch_folder
+from embedding_cache import EmbeddingCache
+from config import (NOTES_FILEPATH, NOTES_LOG_FILEPATH, NOTES_SNAPSHOT_FILEPATH, INDEX_DIR, EMBEDDINGS_DIR,
+                    EMBEDDING_MODEL_NAME, INDEX_KIND, PASSAGES, SHARDS, WATCH_FOLDER, WATCH_POLL_SECONDS,
+                    WATCH_CHECKPOINT_FILEPATH)
 
 st.set_page_config(layout="wide")
 
-NOTES_FILEPATH = 'my-notes.json'
-EMBEDDING_MODEL = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# Spans for every stage of a full run of this script, shown in the sidebar timings panel.
+# Fragment reruns are timed by the fragments themselves
+TIMER = timing.RunTimer('page')
+
 HEIGHT = 800
+# Notes per page of the note browser
+PAGE_SIZE = 25
+# What to do with a lightly edited copy of an existing note: 'flag' adds it with a warning,
+# 'merge' keeps only the existing note, None turns the check off
+NEAR_DUPLICATES = 'flag'
 
 # Helper functions
-def add_string_to_dict_in_json_file(new_string):   
+@st.cache_resource
+def load_timing_history():
+    return timing.TimingHistory()
+
+# One note log per process, my-notes.json is migrated into it the first time. Its lock is taken
+# before the embedding cache and the index are opened, they have one writer too
+@st.cache_resource
+def load_note_log():
+    return note_log.open_notes(NOTES_FILEPATH, NOTES_LOG_FILEPATH, NOTES_SNAPSHOT_FILEPATH)
+
+with TIMER.span('load note log'):
     try:
-        with open(NOTES_FILEPATH, 'r') as file:
-            data = json.load(file)
-    except:
-        data = {}  # Initialize as an empty list if file does not exist
+        NOTE_LOG = load_note_log()
+    except note_log.NoteLogLocked as error:
+        st.error(error)
+        st.stop()
+
+# Notes are only ever embedded once per model, the cache and its hit/miss counts live for the whole process
+@st.cache_resource
+def load_embedding_model():
+    # The model itself warms up on a background thread, cached notes don't need to wait for it
+    model = warm_model.get_model(EMBEDDING_MODEL_NAME)
+    return EmbeddingCache(model, EMBEDDING_MODEL_NAME, EMBEDDINGS_DIR)
+
+with TIMER.span('load model'):
+    EMBEDDING_MODEL = load_embedding_model()
+
+@st.cache_resource
+def load_near_duplicate_index():
+    return dedup.build_near_duplicate_index(NOTE_LOG.copy_notes())
+
+# Id, created time, length, title, tags and source of every note, for the paginated note browser and query filters
+@st.cache_resource
+def load_note_metadata():
+    return note_browser.build_note_metadata(NOTE_LOG.copy_notes(), NOTE_LOG.copy_created(), NOTE_LOG.copy_sources())
+
+def add_note(new_string):
+    # Returns (note_id, created, near duplicate (note_id, distance) or None)
+    similar = None
+    if NEAR_DUPLICATES:
+        near_duplicates = load_near_duplicate_index()
+        similar = near_duplicates.find(new_string)
+        if similar and NEAR_DUPLICATES == 'merge':
+            return similar[0], False, similar
+
+    note_id, created = NOTE_LOG.add(new_string, source='sidebar')
+    if created:
+        if NEAR_DUPLICATES:
+            near_duplicates.add(note_id, new_string)
+        load_note_metadata().add(note_id, new_string, NOTE_LOG.created_at(note_id), 'sidebar')
+    return note_id, created, similar
 
-    count = len(data)
-    # Add the new entry to the JSON data
-    data.update({count: new_string})
+def update_note(note_id, new_string):
+    # Only this note is embedded again, on the ingest worker. Returns False when nothing changed
+    if not NOTE_LOG.update(note_id, new_string):
+        return False
+    if NEAR_DUPLICATES:
+        near_duplicates = load_near_duplicate_index()
+        near_duplicates.remove(note_id)
+        near_duplicates.add(note_id, new_string)
+    load_note_metadata().add(note_id, new_string, NOTE_LOG.created_at(note_id), NOTE_LOG.source_of(note_id))
+    load_render_cache().invalidate(note_id)
+    INGEST_WORKER.submit(note_id, new_string)
+    return True
 
-    # Write the updated JSON data back to the file
-    with open(NOTES_FILEPATH, 'w') as file:
-        json.dump(data, file, indent=4)
+def delete_note(note_id):
+    # Searches stop returning the note at once, the index is compacted in the background later
+    if not NOTE_LOG.delete(note_id):
+        return False
+    if NEAR_DUPLICATES:
+        load_near_duplicate_index().remove(note_id)
+    load_note_metadata().remove(note_id)
+    load_render_cache().invalidate(note_id)
+    INGEST_WORKER.delete(note_id)
+    return True
+
+def read_notes():
+    return NOTE_LOG.copy_notes()
+
+# Loaded once per process and shared by every session, new notes are added to it in place
+@st.cache_resource
+def load_vector_store():
+    return notes_index.load_or_build(read_notes(), EMBEDDING_MODEL, INDEX_DIR, EMBEDDING_MODEL_NAME, INDEX_KIND, PASSAGES,
+                                     SHARDS)
+
+# Keyword index is rebuilt from the notes once per process and then updated per note
+@st.cache_resource
+def load_lexical_index():
+    return lexical.build_lexical_index(read_notes())
+
+# New notes are embedded and indexed on a background thread, queries use whatever is indexed so far
+@st.cache_resource
+def load_ingest_worker():
+    return ingest.IngestWorker(load_lexical_index(), load_vector_store(), EMBEDDING_MODEL, INDEX_DIR,
+                               EMBEDDING_MODEL_NAME, INDEX_KIND, note_log=NOTE_LOG, passages=PASSAGES,
+                               shards=SHARDS).start()
+
+# New and changed files in WATCH_FOLDER become notes, polled on a background thread
+@st.cache_resource
+def load_folder_watcher():
+    # Taken here, the watcher thread has no script run to call the cached loaders from
+    note_metadata = load_note_metadata()
+    near_duplicates = load_near_duplicate_index() if NEAR_DUPLICATES else None
+    render_cache = load_render_cache()
+    def index_note(note_id, text):
+        if near_duplicates is not None:
+            near_duplicates.remove(note_id)
+            near_duplicates.add(note_id, text)
+        note_metadata.add(note_id, text, NOTE_LOG.created_at(note_id), NOTE_LOG.source_of(note_id))
+        render_cache.invalidate(note_id)
+        INGEST_WORKER.submit(note_id, text, timeout=None)
+    return watch_folder.FolderWatcher(WATCH_FOLDER, NOTE_LOG, WATCH_CHECKPOINT_FILEPATH, index_note,
+                                      poll_seconds=WATCH_POLL_SECONDS).start()
+
+# Results of repeated queries, keyed by the index generation so new and deleted notes invalidate them
+@st.cache_resource
+def load_query_cache():
+    return query_cache.QueryCache()
+
+def search_notes(query, timer, k=4, tags=(), sources=(), after=None, before=None):
+    # Returns (hits, path, span of the best passage of the top note or None), from the query cache when it can.
+    # Only notes with all of tags, from any of sources and created in [after, before) are searched
+    if not query.strip():
+        # Nothing to look up, and no embedding of '' that would wait on the model
+        return [], None, None
+    cache = load_query_cache()
+    filters = load_note_metadata().filters
+    with timer.span('select notes'):
+        allowed = filters.select(tags, sources, after, before)
+    key = query_cache.cache_key(query, INGEST_WORKER.generation, k=k, candidates=retrieval.CANDIDATES, passages=PASSAGES,
+                                filters=(tuple(sorted(tags)), tuple(sorted(sources)), after, before, filters.generation))
+    with timer.span('query cache'):
+        cached = cache.get(key)
+    if cached is not None:
+        return cached
+    if not EMBEDDING_MODEL.embeddings.is_ready() and not lexical.is_keyword_query(query, lexical_index):
+        with st.spinner('Waiting for the embedding model to warm up...'):
+            EMBEDDING_MODEL.embeddings.wait()
+    # Started after the warm up, a cache hit saves the search and not the wait
+    started = time.perf_counter()
+    spans = {}
+    # Whatever the worker last committed, a batch being indexed right now shows up on a later rerun
+    hits, path = retrieval.search(query, INGEST_WORKER.index, lexical_index, EMBEDDING_MODEL, k=k, timer=timer, spans=spans,
+                                  allowed=allowed)
+    span = None
+    if hits:
+        # The passage that matched is highlighted, keyword hits get the passage with most query words
+        note_text = NOTE_LOG.get(hits[0][0])
+        span = spans.get(hits[0][0]) or passages.keyword_span(note_text, query)
+        if span:
+            span = passages.expand_to_fences(note_text, *span)
+    cache.put(key, (hits, path, span), time.perf_counter() - started)
+    return hits, path, span
 
 def return_to_empty():
     return None
 
-def add_line_breaks(text):
-    # Add a line break before exactly ###
-    text = re.sub(r'(?<!\n)(###)', '\n###', text)  # Add a newline before ####
-    # Add a line break before exactly ####
-    text = re.sub(r'(?<!\n)(####)', '\n####', text)  # Add a newline before ###
-    # Add a line break before numbered lists (1. 2. 3. etc.)
-    text = re.sub(r'(?<!\n)(?=\d+\.)', '\n', text)
-    # Add a line break before ```
-    text = re.sub(r'(?<!\n)(?=```)', '\n', text)
-    # Add a line break before -
-    text = re.sub(r'(?<!\n)(?=-)', '\n', text)
-
-    # Add a line break after "python" within triple backticks
-    text = re.sub(r'(```python)(?!\n)', r'\1\n', text)
-    # Add a line break before import
-    text = re.sub(r'(?<!\n)(?=import)', '\n', text)
-    # Add a line break before async def
-    text = re.sub(r'(?<!\n)(?=async def)', '\n', text)
-    # Add a line break after `):` within the code block
-    text = re.sub(r'\):', '):\n', text)  # Match `):` followed by optional whitespace
-    # Add a line break after ) followed by more than four whitespaces
-    text = re.sub(r'\)(?=\s{4,})', ')\n', text)  # Match ) followed by 4 or more whitespaces
-
-    return text
+def day_start(day):
+    # Local midnight of a date as a timestamp, None stays None
+    return time.mktime(day.timetuple()) if day else None
 
+# Formatted results are kept per note id, so showing the same note again skips the formatter
+@st.cache_resource
+def load_render_cache():
+    return formatter.RenderCache()
 
+# The page is made of fragments: adding a note, using the note browser and querying each rerun only
+# their own part of the page. The code outside them runs on full reruns only, and what it loads is cached.
+# Every fragment run gets its own timer, since a fragment rerun never reaches the rest of the script
+@st.fragment
+def ingest_panel():
+    timer = timing.RunTimer('ingest panel')
+    # A form clears the text area once the note is added so reruns don't add it again
+    with st.form('new_note', clear_on_submit=True):
+        new_note = st.text_area('Enter new note', height=HEIGHT)
+        submitted = st.form_submit_button('Add note')
+    # The note browser shows a new note from its next rerun, queries once the note is indexed
+    if submitted and len(new_note) > 1:
+        with timer.span('add note'):
+            note_id, created, similar = add_note(new_note)
+        if not created:
+            st.info(f'Note {note_id} already has this content, nothing was added')
+        else:
+            try:
+                INGEST_WORKER.submit(note_id, new_note)
+            except queue.Full:
+                st.warning(f'Note {note_id} is saved but the indexing queue is full, it will be searchable after a restart')
+        if similar and created:
+            st.warning(f'Note {note_id} looks like an edited copy of note {similar[0]}')
+    st.caption('Embedding cache: {entries} notes, {hits} hits, {misses} misses'.format(**EMBEDDING_MODEL.stats()))
+    model = EMBEDDING_MODEL.embeddings
+    if model.is_ready():
+        st.caption('Embedding model {}: '.format(model.status()) + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in model.timings.items()))
+        backend_stats = model.stats()
+        if backend_stats.get('texts'):
+            st.caption('Embedding backend {model_name}: {dim} dimensions, {texts} texts at {texts_per_second:.0f}/s'.format(**backend_stats))
+    else:
+        st.caption('Embedding model is warming up...')
+    ingest_stats = INGEST_WORKER.stats()
+    if ingest_stats['waiting']:
+        st.caption('Indexing {waiting} notes, oldest waiting {lag_seconds:.1f}s'.format(**ingest_stats))
+    if ingest_stats['last_batch']:
+        st.caption('Last indexed batch: {notes} notes in {seconds:.2f}s, {lag_seconds:.2f}s after they were added'.format(**ingest_stats['last_batch']))
+    if ingest_stats['tombstone_ratio'] or ingest_stats['compactions']:
+        st.caption('Deleted or edited rows in the index: {:.0%}, rebuilt {} times'.format(ingest_stats['tombstone_ratio'], ingest_stats['compactions']))
+    if ingest_stats['error']:
+        st.caption(f"Indexing failed, retrying: {ingest_stats['error']}")
+    if WATCH_FOLDER:
+        watch_stats = load_folder_watcher().stats()
+        st.caption('Watching {folder}: {files} files, {added} notes added, {updated} updated'.format(**watch_stats))
+        if watch_stats['error']:
+            st.caption(f"Watching the folder failed, retrying: {watch_stats['error']}")
+    load_timing_history().record(timer)
 
-with st.sidebar:
-    new_note = st.text_area('Enter new note', height=HEIGHT, on_change=return_to_empty())
-    
-if len(new_note) > 1:
-    add_string_to_dict_in_json_file(new_note)
-try:
-    with open(NOTES_FILEPATH, 'r') as file:
-        my_notes = json.load(file)
-        st.write(my_notes)
-except:
-    st.warning("""You don't have any notes in your database!""")
+@st.fragment
+def note_browser_panel():
+    timer = timing.RunTimer('note browser')
+    with timer.span('load note metadata'):
+        note_metadata = load_note_metadata()
+    if not len(note_metadata):
+        st.warning("""You don't have any notes in your database!""")
+        load_timing_history().record(timer)
+        return
+    with timer.span('render notes'):
+        # Only one page of titles goes to the browser, a note's text is read when it is selected
+        filter_column, sort_column, page_column = st.columns([3, 1, 1])
+        with filter_column:
+            contains = st.text_input('Filter notes by title or id')
+        with sort_column:
+            sort = st.selectbox('Sort notes', list(note_browser.SORTS))
+        total = len(note_metadata.order(sort, contains))
+        pages = max(1, -(-total // PAGE_SIZE))
+        with page_column:
+            page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1)
+        rows, total = note_metadata.page(sort, contains, page - 1, PAGE_SIZE)
+        selection = st.dataframe(rows, hide_index=True, on_select='rerun',
+                                 selection_mode='single-row', key='note_page')
+        st.caption(f'{total} notes')
+        if selection.selection.rows and selection.selection.rows[0] < len(rows):
+            note_id = rows[selection.selection.rows[0]]['id']
+            note_text = NOTE_LOG.get(note_id)
+            if note_text is not None:
+                st.markdown(load_render_cache().format(note_id, note_text))
+                with st.expander(f'Edit note {note_id}'):
+                    with st.form(f'edit_note_{note_id}'):
+                        edited_note = st.text_area('Note text', note_text, height=HEIGHT // 2)
+                        save_column, delete_column = st.columns(2)
+                        save = save_column.form_submit_button('Save changes')
+                        delete = delete_column.form_submit_button('Delete note')
+                # Edits rerun the whole page so the query result can't show the old text
+                try:
+                    if save and len(edited_note) > 1 and update_note(note_id, edited_note):
+                        st.rerun()
+                    if delete and delete_note(note_id):
+                        st.rerun()
+                except queue.Full:
+                    st.warning(f'Note {note_id} is saved but the indexing queue is full, search results catch up after a restart')
+    load_timing_history().record(timer)
 
-try: 
-    vector_store = FAISS.from_texts(my_notes.values(), EMBEDDING_MODEL)
-except: 
-    pass
+@st.fragment
+def query_panel():
+    timer = timing.RunTimer('query panel')
+    query_column, result = st.columns(2)
+    with query_column:
+        query = st.text_input('Query notes',on_change=return_to_empty())
 
+        col1, col2 = st.columns(2)
+        with col1: 
+            as_is = st.checkbox('Return notes as is', help='This feature is currently being developed')
+        with col2: 
+            context = st.checkbox('Return notes as context', help='This feature is currently being developed')
 
-query, result = st.columns(2)
-with query:
-    query = st.text_input('Query notes',on_change=return_to_empty())
+        # Filters pick the notes before the search ranks them, not after
+        with st.expander('Filter notes'):
+            filters = load_note_metadata().filters
+            tags = st.multiselect('With all of these tags', list(filters.tag_counts()), format_func=lambda tag: '#' + tag)
+            sources = st.multiselect('From', note_log.SOURCES)
+            after_column, before_column = st.columns(2)
+            after = after_column.date_input('Created from', value=None)
+            before = before_column.date_input('Created until', value=None)
 
-    col1, col2 = st.columns(2)
-    with col1: 
-        as_is = st.checkbox('Return notes as is', help='This feature is currently being developed')
-    with col2: 
-        context = st.checkbox('Return notes as context', help='This feature is currently being developed')
+    with result:
+        try:
+            hits, path, span = search_notes(query, timer, k=4, tags=tags, sources=sources, after=day_start(after),
+                                            before=day_start(before + datetime.timedelta(days=1)) if before else None)
+            note_id = hits[0][0]
+            with timer.span('format result'):
+                formatted = load_render_cache().format(note_id, NOTE_LOG.get(note_id), span)
+            with timer.span('render result'):
+                if span:
+                    st.markdown(formatted[0])
+                    with st.container(border=True):
+                        st.markdown(formatted[1])
+                    st.markdown(formatted[2])
+                else:
+                    st.markdown(formatted)
+            st.caption(f'Note {note_id}, {path} search' + (f', best passage at characters {span[0]}-{span[1]}' if span else ''))
+        except: 
+            pass
+        cache_stats = load_query_cache().stats()
+        if cache_stats['hits'] or cache_stats['misses']:
+            st.caption('Query cache: {hits} hits, {misses} misses ({hit_rate:.0%}), {saved_ms:.0f} ms of searching saved'.format(**cache_stats))
+    load_timing_history().record(timer)
 
+@st.fragment
+def timings_panel():
+    if st.checkbox('Show timings'):
+        timing_history = load_timing_history()
+        # The latest full run and the latest run of every fragment, fragment reruns show up on Refresh
+        latest = {run['name']: run for run in timing_history.snapshot()}
+        st.button('Refresh timings')
+        st.dataframe([{'part': name, 'ms': round(run['total_ms'], 2),
+                       'stages': ', '.join(f"{item['name']} {item['duration_ms']:.1f}" for item in run['spans'])}
+                      for name, run in latest.items()], hide_index=True)
+        st.line_chart(timing_history.stage_table())
+        st.download_button('Download timings (JSONL)', timing_history.to_jsonl(), 'my-notes-timings.jsonl')
+        st.download_button('Download Chrome trace', timing_history.to_chrome_trace(), 'my-notes-trace.json')
 
 
-with result:
-    try:
-        retriever = vector_store.as_retriever()
-        st.markdown(add_line_breaks(retriever.invoke(query)[0].page_content))
-    except: 
-        pass
+with TIMER.span('load lexical index'):
+    lexical_index = load_lexical_index()
+with TIMER.span('load vector index'):
+    INGEST_WORKER = load_ingest_worker()
+if WATCH_FOLDER:
+    with TIMER.span('start folder watcher'):
+        load_folder_watcher()
 
+with st.sidebar, TIMER.span('ingest panel'):
+    ingest_panel()
+with TIMER.span('note browser'):
+    note_browser_panel()
+with TIMER.span('query panel'):
+    query_panel()
 
+# Timings panel, drawn last so it includes every stage of this run
+load_timing_history().record(TIMER)
+with st.sidebar:
+    timings_panel()
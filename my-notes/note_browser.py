@@ -0,0 +1,130 @@
+'''
+Metadata index behind the paginated note browser.
+
+The page used to st.write() the whole notes dict on every rerun. Now it
+only shows one page of (id, created, length, title) rows, and a note's text
+is read from the note log when it is selected.
+
+NoteMetadata keeps those four fields per note, a few hundred bytes each. The
+sorted and filtered id list for a (sort, filter) pair is computed once and
+reused for every page until a note is added or removed. At 100k notes that
+is one sort of ~0.1 s, then a list slice per page.
+
+Rows also have the note's #tags and source, and the same adds and removes
+keep a note_filters.FilterIndex in filters, the bitmaps that filtered
+searches select their notes from.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+import note_filters
+from note_log import LEGACY_SOURCE
+
+TITLE_LENGTH = 80
+
+
+def note_title(text):
+    # First non-empty line without markdown heading/list markers, without splitting the whole note
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        line = text[start:end].strip().lstrip('#-*> ').strip()
+        if line:
+            return line[:TITLE_LENGTH]
+        start = end + 1
+    return ''
+
+
+def id_key(note_id):
+    # Numeric ids sort as numbers, anything else after them
+    return (0, int(note_id), '') if note_id.isdigit() else (1, 0, note_id)
+
+
+# Sort name: (key function over a row, reverse)
+SORTS = {
+    'newest': (lambda row: (row['created'] or 0, id_key(row['id'])), True),
+    'oldest': (lambda row: (row['created'] or 0, id_key(row['id'])), False),
+    'longest': (lambda row: row['length'], True),
+    'shortest': (lambda row: row['length'], False),
+    'title': (lambda row: row['title'].lower(), False),
+    'id': (lambda row: id_key(row['id']), False),
+}
+
+
+class NoteMetadata:
+    def __init__(self, max_orders=16):
+        self.rows = {}
+        self.filters = note_filters.FilterIndex()
+        self.generation = 0
+        self.orders = OrderedDict()
+        self.max_orders = max_orders
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, note_id, text, created=None, source=None):
+        self.add_many([(note_id, text, created, source)])
+
+    def add_many(self, notes):
+        # notes is [(note_id, text, created, source), ...]
+        rows, filters = [], []
+        for note_id, text, created, source in notes:
+            tags = note_filters.note_tags(text)
+            source = source or LEGACY_SOURCE
+            rows.append({'id': note_id, 'created': created, 'length': len(text), 'title': note_title(text),
+                         'tags': ' '.join('#' + tag for tag in tags), 'source': source})
+            filters.append((note_id, tags, source, created))
+        self.filters.add_many(filters)
+        with self.lock:
+            for row in rows:
+                self.rows[row['id']] = row
+            self.generation += 1
+
+    def remove(self, note_id):
+        self.filters.remove(note_id)
+        with self.lock:
+            if self.rows.pop(note_id, None) is not None:
+                self.generation += 1
+
+    def order(self, sort='newest', contains=''):
+        # Ids matching `contains` (case insensitive, on the title) in `sort` order
+        contains = contains.strip().lower()
+        key = (sort, contains)
+        with self.lock:
+            cached = self.orders.get(key)
+            if cached is not None and cached[0] == self.generation:
+                self.orders.move_to_end(key)
+                return cached[1]
+            generation = self.generation
+            rows = list(self.rows.values())
+        if contains:
+            rows = [row for row in rows if contains in row['title'].lower() or contains == row['id']]
+        sort_key, reverse = SORTS[sort]
+        ids = [row['id'] for row in sorted(rows, key=sort_key, reverse=reverse)]
+        with self.lock:
+            self.orders[key] = (generation, ids)
+            if len(self.orders) > self.max_orders:
+                self.orders.popitem(last=False)
+        return ids
+
+    def page(self, sort='newest', contains='', page=0, page_size=25):
+        # Returns (rows on that page, number of matching notes), page counts from 0
+        ids = self.order(sort, contains)
+        with self.lock:
+            rows = [self.rows[note_id] for note_id in ids[page * page_size:(page + 1) * page_size] if note_id in self.rows]
+        return [dict(row, created=format_created(row['created'])) for row in rows], len(ids)
+
+
+def format_created(created):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(created)) if created else ''
+
+
+def build_note_metadata(notes, created, sources=None):
+    metadata = NoteMetadata()
+    sources = sources or {}
+    metadata.add_many([(note_id, text, created.get(note_id), sources.get(note_id)) for note_id, text in notes.items()])
+    return metadata
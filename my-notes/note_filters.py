@@ -0,0 +1,208 @@
+'''
+Tag, source and date filters for searches, as precomputed bitmaps.
+
+Filtering the top k after retrieval throws most of it away: of 20
+candidates maybe two are #bigquery notes from last month. Instead a filter
+first picks the notes it allows and the searches only look at those, see
+the allowed argument of NotesIndex.search_many() and BM25Index.search().
+
+FilterIndex gives every note a bit number and keeps a bitmap (a Python int
+used as a bitset) per tag, per source and per created month. A filter is
+the AND of the tags asked for, the OR of the sources and the OR of the
+months in the date range. Only in the months at the two ends of the range
+is each note's created time compared. The bitmap operations run in C a
+machine word at a time, so they take microseconds even at 100k notes.
+
+select() returns the allowed note ids as a frozenset, cached per filter
+until a note changes. The indexes cache the row mask they make from it
+under that same object, so a repeated filtered query costs what the
+unfiltered one does. A narrow filter is cheaper, because only the allowed
+rows are scored.
+
+Tags are the #hashtags in a note's text, outside code fences.
+'''
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import passages as note_passages
+
+HASHTAG = re.compile(r'(?<![\w#&/])#([A-Za-z][\w-]*)')
+# Month of notes with no created time, never matched by a date range
+NO_MONTH = ''
+
+
+def note_tags(text):
+    # Sorted lowercased #hashtags, a # heading needs a space so it never counts
+    fences = note_passages.fence_ranges(text)
+    tags = set()
+    for match in HASHTAG.finditer(text):
+        if not any(start <= match.start() < end for start, end in fences):
+            tags.add(match.group(1).lower())
+    return sorted(tags)
+
+
+def created_month(created):
+    return time.strftime('%Y-%m', time.localtime(created)) if created else NO_MONTH
+
+
+def month_bounds(month):
+    # (first second of the month, first second of the next one), local time
+    year, number = map(int, month.split('-'))
+    start = time.mktime((year, number, 1, 0, 0, 0, 0, 0, -1))
+    end = time.mktime((year + number // 12, number % 12 + 1, 1, 0, 0, 0, 0, 0, -1))
+    return start, end
+
+
+def set_bits(bitmap):
+    # Numbers of the bits set in a bitmap, lowest first
+    if not bitmap:
+        return np.zeros(0, dtype='int64')
+    data = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'), dtype='uint8')
+    return np.flatnonzero(np.unpackbits(data, bitorder='little'))
+
+
+def from_bits(bits):
+    # A bitmap with the given bit numbers set
+    if not len(bits):
+        return 0
+    flags = np.zeros(max(bits) + 1, dtype=bool)
+    flags[bits] = True
+    return int.from_bytes(np.packbits(flags, bitorder='little').tobytes(), 'little')
+
+
+class FilterIndex:
+    '''Bitmaps of the notes with each tag, source and created month'''
+
+    def __init__(self, max_selections=32):
+        # note_id -> (bit, tags, source, month), and the note id and created time of every bit
+        self.entries = {}
+        self.ids = []
+        self.created = []
+        self.live = 0
+        self.tags = {}
+        self.sources = {}
+        self.months = {}
+        self.generation = 0
+        self.selections = OrderedDict()
+        self.max_selections = max_selections
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, note_id, tags, source, created=None):
+        self.add_many([(note_id, tags, source, created)])
+
+    def add_many(self, notes):
+        # notes is [(note_id, tags, source, created), ...], each bitmap is rebuilt once for all of them
+        with self.lock:
+            keys = {}
+            for note_id, tags, source, created in notes:
+                entry = self.entries.get(note_id)
+                if entry is not None:
+                    bit = entry[0]
+                    self._clear(entry)
+                else:
+                    bit = len(self.ids)
+                    self.ids.append(note_id)
+                    self.created.append(None)
+                month = created_month(created)
+                self.created[bit] = created
+                self.entries[note_id] = (bit, tuple(tags), source, month)
+                keys.setdefault(('live', None), []).append(bit)
+                for tag in tags:
+                    keys.setdefault(('tags', tag), []).append(bit)
+                keys.setdefault(('sources', source), []).append(bit)
+                keys.setdefault(('months', month), []).append(bit)
+            for (name, key), bits in keys.items():
+                if name == 'live':
+                    self.live |= from_bits(bits)
+                else:
+                    bitmaps = getattr(self, name)
+                    bitmaps[key] = bitmaps.get(key, 0) | from_bits(bits)
+            self.generation += 1
+
+    def _clear(self, entry):
+        # Caller holds self.lock
+        bit, tags, source, month = entry
+        mask = ~(1 << bit)
+        self.live &= mask
+        for bitmaps, key in [(self.tags, tag) for tag in tags] + [(self.sources, source), (self.months, month)]:
+            bitmaps[key] &= mask
+            if not bitmaps[key]:
+                del bitmaps[key]
+
+    def remove(self, note_id):
+        with self.lock:
+            entry = self.entries.pop(note_id, None)
+            if entry is not None:
+                self._clear(entry)
+                self.ids[entry[0]] = None
+                self.generation += 1
+
+    def tag_counts(self):
+        # {tag: number of notes}, most used first
+        with self.lock:
+            counts = {tag: bitmap.bit_count() for tag, bitmap in self.tags.items()}
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+    def source_counts(self):
+        with self.lock:
+            return {source: bitmap.bit_count() for source, bitmap in self.sources.items()}
+
+    def select(self, tags=(), sources=(), after=None, before=None):
+        # frozenset of the note ids with every one of tags, from any of sources, created in [after, before).
+        # None when nothing is asked for, searches then skip filtering altogether
+        if not tags and not sources and after is None and before is None:
+            return None
+        key = (tuple(sorted(tags)), tuple(sorted(sources)), after, before)
+        with self.lock:
+            cached = self.selections.get(key)
+            if cached is not None and cached[0] == self.generation:
+                self.selections.move_to_end(key)
+                return cached[1]
+            bitmap = self.live
+            for tag in tags:
+                bitmap &= self.tags.get(tag, 0)
+            if sources:
+                bitmap &= self._any(self.sources, sources)
+            if after is not None or before is not None:
+                bitmap &= self._dates(after, before)
+            allowed = frozenset(self.ids[bit] for bit in set_bits(bitmap))
+            self.selections[key] = (self.generation, allowed)
+            if len(self.selections) > self.max_selections:
+                self.selections.popitem(last=False)
+            return allowed
+
+    def _any(self, bitmaps, keys):
+        bitmap = 0
+        for key in keys:
+            bitmap |= bitmaps.get(key, 0)
+        return bitmap
+
+    def _dates(self, after, before):
+        # Caller holds self.lock. Whole months in the range are taken as they are, the rest note by note
+        low = after if after is not None else float('-inf')
+        high = before if before is not None else float('inf')
+        bitmap = 0
+        for month, month_bitmap in self.months.items():
+            if month == NO_MONTH:
+                continue
+            start, end = month_bounds(month)
+            if low <= start and end <= high:
+                bitmap |= month_bitmap
+            elif start < high and low < end:
+                bits = set_bits(month_bitmap)
+                created = np.array([self.created[bit] for bit in bits], dtype='float64')
+                bitmap |= from_bits(bits[(created >= low) & (created < high)])
+        return bitmap
+
+
+def build_filter_index(notes, created, sources):
+    filters = FilterIndex()
+    filters.add_many([(note_id, note_tags(text), sources.get(note_id), created.get(note_id)) for note_id, text in notes.items()])
+    return filters
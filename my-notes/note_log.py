@@ -0,0 +1,411 @@
+'''
+Append-only note store.
+
+Replaces the read-modify-write of my-notes.json. Every change is one JSON
+line appended to my-notes.log, so adding a note costs the same no matter
+how many notes there are. The current notes are rebuilt on open from:
+    my-notes.bodies.<n>     - note bodies as of the snapshot, see body_store.py
+    my-notes.snapshot.json  - {"version", "seq", "bodies_file", "bodies", "hashes", "created",
+                              "sources", "next_id"} as of record `seq`, "bodies" holds the
+                              [offset, length, compressed] of every note in the body file
+    my-notes.log            - records after the snapshot, one per line:
+                              {"seq": 12, "op": "add", "id": "12", "text": "...", "ts": 1722470400.0, "source": "sidebar"}
+                              {"seq": 13, "op": "update", "id": "12", "text": "...", "ts": 1722470460.0}
+                              {"seq": 14, "op": "delete", "id": "12", "ts": 1722470520.0}
+
+Writes use group commit: appenders queue their line and whichever thread
+gets to the disk first writes every queued line and fsyncs once for all of
+them. A line cut off by a crash is detected on open and trimmed away.
+
+Notes are content addressed: adding text whose dedup.content_hash() is
+already stored returns the existing id and writes nothing.
+
+Only notes added or edited since the snapshot are held in memory. The rest
+are read from the memory-mapped body file when get() asks for them, so the
+process doesn't grow with the number of notes. copy_notes() still reads
+every body, it is for building indexes.
+
+compact() appends the in-memory notes to the body file, writes a fresh
+snapshot and empties the log. Records already in the snapshot are skipped on
+replay, so a crash between the steps is safe. Once more than
+MAX_DEAD_BODY_RATIO of the body file is old versions of notes, compact()
+copies the live bodies to a new body file first.
+maybe_compact() does it once the log is large, or once updates and deletes
+have made a large part of the log dead.
+
+Only one process may write: a second writer would hand out the same ids and
+sequence numbers and one of the records would be lost. A NoteLog holds an
+exclusive flock on my-notes.log.lock from open to close(), and opening
+another fails with NoteLogLocked. With read_only=True nothing is locked or
+written, a line still being appended is not mistaken for a torn write, for
+tools that only search the notes.
+
+Every add records where the note came from, one of SOURCES. Notes from
+before sources were recorded, my-notes.json ones included, are
+LEGACY_SOURCE.
+
+    python note_log.py migrate    # one-time import of my-notes.json
+    python note_log.py compact
+'''
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows, nothing stops a second writer there
+    fcntl = None
+
+from dedup import content_hash
+from body_store import BodyStore
+from config import NOTES_FILEPATH, NOTES_LOG_FILEPATH, NOTES_SNAPSHOT_FILEPATH, NOTES_BODIES_FILEPATH, COMPRESS_NOTES
+
+SNAPSHOT_VERSION = 2
+# Version 1 snapshots held the note texts themselves
+TEXT_SNAPSHOT_VERSION = 1
+MAX_DEAD_BODY_RATIO = 0.5
+# Typed into the page's sidebar, or read from a file by watch_folder.py or bulk_import.py
+SOURCES = ['legacy', 'sidebar', 'file']
+LEGACY_SOURCE = 'legacy'
+
+
+class NoteLogLocked(RuntimeError):
+    pass
+
+
+def lock_writer(log_path):
+    # Returns the fd of log_path.lock with an exclusive lock held on it, raises NoteLogLocked when another process has it
+    lock_path = log_path + '.lock'
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise NoteLogLocked(f'{log_path} is open for writing in another process (the notes app, watch_folder.py or '
+                                f'bulk_import.py), only one may write at a time. Locked by {lock_path}')
+    return fd
+
+
+def write_snapshot(snapshot_path, snapshot):
+    # Written to a temp file and swapped in so a crash never leaves half a snapshot
+    with open(snapshot_path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+
+
+class NoteLog:
+    def __init__(self, log_path, snapshot_path, bodies_path=None, compress=True, read_only=False):
+        self.log_path = log_path
+        self.read_only = read_only
+        # Taken before replay, which trims the log
+        self.lock_fd = None if read_only else lock_writer(log_path)
+        self.snapshot_path = snapshot_path
+        self.bodies_path = bodies_path or os.path.splitext(log_path)[0] + '.bodies'
+        self.bodies_generation = 1
+        self.bodies = BodyStore(f'{self.bodies_path}.{self.bodies_generation}', compress=compress)
+        # Texts of notes added or edited since the snapshot, every other note is in self.bodies
+        self.recent = {}
+        self.snapshot_version = SNAPSHOT_VERSION
+        self.created = {}
+        # Where each note came from, notes without one are LEGACY_SOURCE
+        self.sources = {}
+        self.hashes = {}
+        self.seq = 0
+        # Update and delete records since the snapshot, each one makes an older record dead
+        self.dead_records = 0
+        self.snapshot_seq = 0
+        self.durable_seq = 0
+        self.next_id = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        try:
+            self._load_snapshot()
+            self._replay()
+        except BaseException:
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+            raise
+        self.fd = None if read_only else os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+        self.snapshot_version = snapshot.get('version', TEXT_SNAPSHOT_VERSION)
+        self.created = snapshot.get('created', {})
+        self.sources = snapshot.get('sources', {})
+        self.seq = self.snapshot_seq = self.durable_seq = snapshot['seq']
+        # Deleted notes are not in the snapshot, next_id keeps their ids from being reused
+        self.next_id = snapshot.get('next_id', 0)
+        if self.snapshot_version == TEXT_SNAPSHOT_VERSION:
+            # open_notes() compacts these into the body file straight away
+            self.recent = snapshot['notes']
+            for note_id, text in self.recent.items():
+                self.hashes.setdefault(content_hash(text), note_id)
+                self._bump_next_id(note_id)
+            return
+        self.bodies_generation = snapshot['bodies_generation']
+        self.bodies = BodyStore(snapshot['bodies_file'], snapshot['bodies'], self.bodies.compress)
+        self.hashes = snapshot['hashes']
+
+    def _replay(self):
+        try:
+            file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        good_offset = 0
+        with file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good_offset += len(line)
+                if record['seq'] > self.seq:
+                    self._apply(record)
+                    self.seq = self.durable_seq = record['seq']
+        # Anything after the last complete record is a torn write from a crash, or being written when read only
+        if not self.read_only and good_offset != os.path.getsize(self.log_path):
+            with open(self.log_path, 'r+b') as file:
+                file.truncate(good_offset)
+
+    def _bump_next_id(self, note_id):
+        if note_id.isdigit():
+            self.next_id = max(self.next_id, int(note_id) + 1)
+
+    def _text(self, note_id):
+        # Caller holds self.lock
+        text = self.recent.get(note_id)
+        return text if text is not None else self.bodies.get(note_id)
+
+    def _apply(self, record):
+        note_id = record['id']
+        exists = note_id in self.recent or note_id in self.bodies
+        if record['op'] == 'add':
+            self.recent[note_id] = record['text']
+            self.created[note_id] = record.get('ts')
+            if record.get('source'):
+                self.sources[note_id] = record['source']
+            self.hashes.setdefault(content_hash(record['text']), note_id)
+            self._bump_next_id(note_id)
+        elif record['op'] == 'update' and exists:
+            self._unhash(note_id)
+            self.bodies.remove(note_id)
+            self.recent[note_id] = record['text']
+            self.hashes.setdefault(content_hash(record['text']), note_id)
+            self.dead_records += 1
+        elif record['op'] == 'delete' and exists:
+            self._unhash(note_id)
+            self.bodies.remove(note_id)
+            self.recent.pop(note_id, None)
+            self.created.pop(note_id, None)
+            self.sources.pop(note_id, None)
+            self.dead_records += 1
+
+    def _unhash(self, note_id):
+        item = content_hash(self._text(note_id))
+        if self.hashes.get(item) == note_id:
+            del self.hashes[item]
+
+    def _queue(self, record):
+        # Caller holds self.lock
+        if self.read_only:
+            raise ValueError(f'{self.log_path} was opened read only')
+        self.seq += 1
+        record['seq'] = self.seq
+        self._apply(record)
+        self.pending.append(json.dumps(record) + '\n')
+        return self.seq
+
+    def _commit(self, seq):
+        with self.commit_lock:
+            # Another thread's fsync may already have covered this record
+            if self.durable_seq >= seq:
+                return
+            with self.lock:
+                data = ''.join(self.pending).encode('utf-8')
+                self.pending = []
+                last_seq = self.seq
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            os.fsync(self.fd)
+            self.durable_seq = last_seq
+
+    def add(self, text, source=None):
+        return self.add_many([text], source)[0]
+
+    def add_many(self, texts, source=None):
+        # All new texts share one commit, returns [(note_id, created), ...]. source is one of SOURCES
+        results = []
+        seq = None
+        with self.lock:
+            for text in texts:
+                note_id = self.hashes.get(content_hash(text))
+                if note_id is not None:
+                    results.append((note_id, False))
+                    continue
+                note_id = str(self.next_id)
+                results.append((note_id, True))
+                record = {'op': 'add', 'id': note_id, 'text': text, 'ts': time.time()}
+                if source:
+                    record['source'] = source
+                seq = self._queue(record)
+        if seq is not None:
+            self._commit(seq)
+        return results
+
+    def update(self, note_id, text):
+        # Returns False when there is no such note or the text is unchanged
+        with self.lock:
+            if self._text(note_id) in (None, text):
+                return False
+            seq = self._queue({'op': 'update', 'id': note_id, 'text': text, 'ts': time.time()})
+        self._commit(seq)
+        return True
+
+    def delete(self, note_id):
+        # Returns False when there is no such note
+        with self.lock:
+            if note_id not in self.recent and note_id not in self.bodies:
+                return False
+            seq = self._queue({'op': 'delete', 'id': note_id, 'ts': time.time()})
+        self._commit(seq)
+        return True
+
+    def copy_notes(self):
+        # Reads every body, for building indexes. Use get() to show a note
+        with self.lock:
+            notes = {note_id: self.bodies.get(note_id) for note_id in self.bodies.entries}
+            notes.update(self.recent)
+            return notes
+
+    def copy_created(self):
+        with self.lock:
+            return dict(self.created)
+
+    def get(self, note_id):
+        with self.lock:
+            return self._text(note_id)
+
+    def copy_sources(self):
+        # Every note's source, LEGACY_SOURCE included
+        with self.lock:
+            return {note_id: self.sources.get(note_id, LEGACY_SOURCE) for note_id in itertools.chain(self.bodies.entries, self.recent)}
+
+    def source_of(self, note_id):
+        with self.lock:
+            return self.sources.get(note_id, LEGACY_SOURCE)
+
+    def created_at(self, note_id):
+        with self.lock:
+            return self.created.get(note_id)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.bodies) + len(self.recent)
+
+    def log_size(self):
+        return os.path.getsize(self.log_path)
+
+    def compact(self):
+        if self.read_only:
+            raise ValueError(f'{self.log_path} was opened read only')
+        with self.commit_lock, self.lock:
+            # Bodies are on disk before the snapshot that points at them
+            if self.recent:
+                self.bodies.write(self.recent)
+            old_bodies = None
+            if self.bodies.dead_ratio() > MAX_DEAD_BODY_RATIO:
+                old_bodies = self.bodies
+                self.bodies_generation += 1
+                self.bodies = old_bodies.rewrite(f'{self.bodies_path}.{self.bodies_generation}')
+            write_snapshot(self.snapshot_path, {
+                'version': SNAPSHOT_VERSION,
+                'seq': self.seq,
+                'bodies_file': self.bodies.path,
+                'bodies_generation': self.bodies_generation,
+                'bodies': self.bodies.entries,
+                'hashes': self.hashes,
+                'created': self.created,
+                'sources': self.sources,
+                'next_id': self.next_id,
+            })
+            if old_bodies is not None:
+                old_bodies.close()
+                os.remove(old_bodies.path)
+            self.recent = {}
+            self.snapshot_version = SNAPSHOT_VERSION
+            # Pending lines are already part of the snapshot
+            self.pending = []
+            self.durable_seq = self.snapshot_seq = self.seq
+            self.dead_records = 0
+            os.ftruncate(self.fd, 0)
+
+    def maybe_compact(self, max_log_bytes=4 * 1024 * 1024, max_dead_ratio=0.2):
+        # Returns True when it compacted
+        if self.log_size() > max_log_bytes or self.dead_records > max_dead_ratio * max(len(self), 10):
+            self.compact()
+            return True
+        return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.bodies.close()
+        if self.lock_fd is not None:
+            # Closing the fd releases the lock
+            os.close(self.lock_fd)
+
+
+def migrate_json(json_path, log_path, snapshot_path):
+    # One-time import of the old my-notes.json, returns False if there was nothing to do
+    if os.path.exists(snapshot_path) or os.path.exists(log_path) or not os.path.exists(json_path):
+        return False
+    with open(json_path, 'r') as file:
+        notes = json.load(file)
+    write_snapshot(snapshot_path, {
+        'version': TEXT_SNAPSHOT_VERSION,
+        'seq': 0,
+        'notes': {str(key): value for key, value in notes.items()},
+        'created': {},
+    })
+    return True
+
+
+def open_notes(json_path, log_path, snapshot_path, bodies_path=NOTES_BODIES_FILEPATH, compress=COMPRESS_NOTES, read_only=False):
+    migrate_json(json_path, log_path, snapshot_path)
+    log = NoteLog(log_path, snapshot_path, bodies_path, compress, read_only)
+    if log.snapshot_version == TEXT_SNAPSHOT_VERSION and not read_only:
+        # Moves the texts out of an old snapshot into the body file
+        log.compact()
+    return log
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'migrate':
+        print('migrated' if migrate_json(NOTES_FILEPATH, NOTES_LOG_FILEPATH, NOTES_SNAPSHOT_FILEPATH) else 'nothing to migrate')
+    elif command == 'compact':
+        try:
+            log = open_notes(NOTES_FILEPATH, NOTES_LOG_FILEPATH, NOTES_SNAPSHOT_FILEPATH)
+        except NoteLogLocked as error:
+            sys.exit(str(error))
+        log.compact()
+        print(f'compacted {len(log)} notes at seq {log.seq} into {log.bodies.path}')
+        log.close()
+    else:
+        print('usage: python note_log.py migrate|compact')
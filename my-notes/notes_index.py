@@ -0,0 +1,741 @@
+'''
+Persistent FAISS index for my notes.
+
+The index is saved next to my-notes.json so it only has to be built once.
+New notes are embedded and appended to the saved index instead of calling
+FAISS.from_texts() over the whole corpus on every streamlit rerun.
+
+The index directory holds two files:
+    index.faiss  - the raw faiss index (vectors.npy for the npy kinds)
+    meta.json    - format version, index kind, model name, dimension, note
+                   ids and a content hash per note
+
+On load the meta is compared against the current notes. A different format
+version, model or dimension means the index is rebuilt. Notes missing from
+the index or whose text changed are embedded and added.
+
+Deleting a note, or indexing a new version of it, leaves its old row in the
+index as a tombstone. Searches skip tombstoned rows right away, and once
+more than MAX_TOMBSTONE_RATIO of the rows are tombstones the index is
+rebuilt from the current notes with compact_index().
+
+With passages=True the rows are passages of notes instead (see passages.py)
+and a PassageIndex turns passage hits back into note hits, each note scored
+by its best passage. Passage rows carry their own content hash, so an edited
+note only gets new rows for the passages whose text changed, and a passage
+that merely moved is an embedding cache hit.
+
+Index kinds, picked automatically from the corpus size unless asked for:
+    flat   - exact search, float32 vectors in RAM (default below 50k notes)
+    hnsw   - HNSW graph over float32 vectors, fast approximate search (below 500k)
+    sq8    - exact scan over int8 scalar quantized vectors, 4x less memory
+    ivfpq  - inverted lists with product quantized codes, candidates re-ranked
+             with int8 vectors, for around 1M passages
+    npy16  - exact NumPy search over a memory-mapped float16 .npy, loads
+             without reading the vectors and takes half the disk and page
+             cache of flat, but every search converts the rows to float32
+    npy32  - the same with float32 rows, searched straight from the mapping
+sq8 and ivfpq are trained on the vectors they are built from, with fewer
+than MIN_TRAINING_POINTS of them build_index() makes a flat index. Use
+build_index.py to rebuild with a given kind and compare recall and latency
+against flat.
+
+With shards=N the rows are split over N indexes searched by worker
+processes, see sharded_index.py. meta.json then only has the shard count,
+each shard has its own directory.
+
+Searches take an optional allowed frozenset of ids (see note_filters.py)
+and only rank those rows, the filter is applied inside the search and not to
+its results. The row numbers of an allowed set are cached per set until the
+rows change. A set of at most SUBSET_SHARE of the rows is scored exactly on
+its own, against a cached copy of its vectors when it has at most
+EXACT_FILTER_ROWS rows. Larger sets go through the whole index with the
+other rows masked out, by a faiss IDSelectorBitmap or a row mask for the npy
+kinds, at the cost of an unfiltered search. HNSW is the exception: a graph
+search costs about as much as scoring HNSW_EXACT_ROWS rows, so bigger sets
+use the graph, unless they are under HNSW_MIN_SHARE of it and the walk would
+miss most of them. sq8 and ivfpq only score apart the sets whose vectors
+are cached, decoding more of their rows per query costs more than the
+filtered search.
+'''
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import faiss
+
+import passages as note_passages
+
+INDEX_VERSION = 2
+INDEX_KINDS = ['flat', 'hnsw', 'sq8', 'ivfpq', 'npy16', 'npy32']
+# Kinds searched with NumPy instead of faiss, and the dtype of their saved vectors
+NUMPY_KINDS = {'npy16': 'float16', 'npy32': 'float32'}
+INDEX_FILENAME = 'index.faiss'
+VECTORS_FILENAME = 'vectors.npy'
+META_FILENAME = 'meta.json'
+# Rows per matrix product in NumpyIndex searches
+SEARCH_CHUNK = 16384
+# Fewest vectors each trained kind can be trained on, PQ needs one per centroid of its 4 bit codes
+MIN_TRAINING_POINTS = {'sq8': 1, 'ivfpq': 16}
+# Rebuild the index once this share of its rows belong to deleted or edited notes
+MAX_TOMBSTONE_RATIO = 0.2
+# Allowed sets up to this many rows keep a copy of their vectors for exact scoring
+EXACT_FILTER_ROWS = 4096
+# Allowed sets whose rows are cached, per index
+MAX_FILTERS = 8
+# Larger allowed sets are searched like the whole index with the other rows masked, scoring them apart costs more
+SUBSET_SHARE = 0.25
+# Allowed sets scored exactly in an HNSW index: up to about the cost of a graph search, and any set
+# small enough that the graph walk misses most of it
+HNSW_EXACT_ROWS = 10_000
+HNSW_MIN_SHARE = 0.05
+
+
+def note_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def to_matrix(vectors):
+    # faiss wants a contiguous float32 matrix, normalized so inner product is cosine
+    matrix = np.ascontiguousarray(np.asarray(vectors, dtype='float32'))
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    faiss.normalize_L2(matrix)
+    return matrix
+
+
+def check_embeddings(model_name, embeddings):
+    # Vectors of another model or backend (see embedders.py) are not comparable with the ones indexed
+    other = getattr(embeddings, 'model_name', model_name)
+    if other != model_name:
+        raise ValueError(f'Index of {model_name} vectors can not take vectors from {other}')
+
+
+def check_dim(dim, matrix):
+    if matrix.shape[1] != dim:
+        raise ValueError(f'Index of {dim} dimensional vectors can not take {matrix.shape[1]} dimensional ones')
+
+
+def choose_index_kind(count):
+    if count < 50_000:
+        return 'flat'
+    if count < 500_000:
+        return 'hnsw'
+    return 'ivfpq'
+
+
+def ivf_lists(count):
+    # Roughly 4 * sqrt(n) lists, with enough points per list to train the centroids
+    return max(1, min(int(4 * count ** 0.5), count // 39))
+
+
+def pq_subquantizers(dim):
+    # 8 dimensions per sub-vector when the dimension allows it
+    for m in (dim // 8, 48, 32, 16, 8, 4, 2, 1):
+        if m and dim % m == 0:
+            return m
+
+
+def make_faiss_index(kind, dim, count):
+    if kind == 'flat':
+        return faiss.IndexFlatIP(dim)
+    if kind == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 80
+        return index
+    if kind == 'sq8':
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    if kind == 'ivfpq':
+        # PQ codebooks need 256 training points each, fewer notes get 4 bit codes
+        bits = 8 if count >= 256 * 39 else 4
+        ivfpq = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, ivf_lists(count), pq_subquantizers(dim), bits, faiss.METRIC_INNER_PRODUCT)
+        # PQ codes alone lose too much recall, re-rank k_factor * k candidates with int8 vectors
+        refine = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexRefine(ivfpq, refine)
+    raise ValueError(f'Unknown index kind {kind!r}, expected one of {INDEX_KINDS}')
+
+
+def set_search_params(index, ef_search=64, nprobe=16, k_factor=8):
+    # Search time knobs, they are not all saved with the index so they are set after every load
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    if isinstance(index, faiss.IndexRefine):
+        index.k_factor = k_factor
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = nprobe
+
+
+def filtered_search_params(index, selector):
+    # Search parameters that only let the rows in selector through, with the index's own search knobs
+    if isinstance(index, faiss.IndexRefine):
+        base = filtered_search_params(faiss.downcast_index(index.base_index), selector)
+        return faiss.IndexRefineSearchParameters(k_factor=index.k_factor, base_index_params=base)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+def can_train(kind, count):
+    return count >= MIN_TRAINING_POINTS.get(kind, 0)
+
+
+def train(index, matrix, max_points=100_000):
+    if not index.is_trained:
+        if len(matrix) > max_points:
+            matrix = matrix[np.random.default_rng(0).choice(len(matrix), max_points, replace=False)]
+        index.train(matrix)
+
+
+class NotesIndex:
+    # Set by ShardedIndex, a NotesIndex is one index in this process
+    shards = None
+
+    def __init__(self, dim, model_name, index=None, ids=None, hashes=None, kind='flat', tombstones=None):
+        self.dim = dim
+        self.model_name = model_name
+        self.kind = kind
+        self.index = index if index is not None else make_faiss_index(kind, dim, 0)
+        set_search_params(self.index)
+        self._set_rows(ids, hashes, tombstones)
+        self.lock = threading.Lock()
+
+    def _set_rows(self, ids, hashes, tombstones):
+        # ids has the note id of every row, rows maps each indexed note to its current row
+        self.ids = list(ids or [])
+        self.hashes = dict(hashes or {})
+        self.tombstones = set(tombstones or [])
+        self.rows = {note_id: row for row, note_id in enumerate(self.ids) if row not in self.tombstones}
+        # Bumped whenever rows change, the cached rows of an allowed set are only used at the same version
+        self.version = 0
+        self.filters = OrderedDict()
+
+    def _add_rows(self, ids, texts):
+        # Caller holds self.lock. A note that is already indexed gets a new row and its old row a tombstone
+        for note_id, text in zip(ids, texts):
+            old_row = self.rows.get(note_id)
+            if old_row is not None:
+                self.tombstones.add(old_row)
+            self.rows[note_id] = len(self.ids)
+            self.ids.append(note_id)
+            self.hashes[note_id] = note_hash(text)
+        self.version += 1
+
+    def _filter(self, allowed):
+        # Caller holds self.lock. {'rows': sorted rows of the allowed ids, ...}, searches cache more in it
+        cached = self.filters.get(allowed)
+        if cached is not None and cached['version'] == self.version:
+            self.filters.move_to_end(allowed)
+            return cached
+        rows = np.array(sorted(self.rows[item] for item in allowed if item in self.rows), dtype='int64')
+        cached = self.filters[allowed] = {'version': self.version, 'rows': rows}
+        self.filters.move_to_end(allowed)
+        if len(self.filters) > MAX_FILTERS:
+            self.filters.popitem(last=False)
+        return cached
+
+    def _hits(self, scores, rows, k):
+        # Caller holds self.lock
+        hits = []
+        for score, row in zip(scores, rows):
+            if row != -1 and row not in self.tombstones:
+                hits.append((self.ids[row], float(score)))
+                if len(hits) == k:
+                    break
+        return hits
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, ids, texts, vectors):
+        matrix = to_matrix(vectors)
+        check_dim(self.dim, matrix)
+        with self.lock:
+            self.index.add(matrix)
+            self._add_rows(ids, texts)
+
+    def upsert(self, notes, embeddings):
+        # notes is {note_id: text} of notes that are new or changed
+        check_embeddings(self.model_name, embeddings)
+        ids = list(notes.keys())
+        texts = [notes[note_id] for note_id in ids]
+        self.add(ids, texts, embeddings.embed_documents(texts))
+
+    def remove(self, note_id):
+        # The row stays in the index as a tombstone until the index is rebuilt
+        with self.lock:
+            row = self.rows.pop(note_id, None)
+            self.hashes.pop(note_id, None)
+            if row is not None:
+                self.tombstones.add(row)
+                self.version += 1
+            return row is not None
+
+    def tombstone_ratio(self):
+        with self.lock:
+            return len(self.tombstones) / len(self.ids) if self.ids else 0.0
+
+    def search(self, vector, k=4, allowed=None):
+        # Returns [(note_id, score), ...] best first, only ids in allowed when it is given
+        return self.search_many(vector, k, allowed)[0]
+
+    def search_many(self, vectors, k=4, allowed=None):
+        # One faiss call for a batch of query vectors, returns one hit list per query
+        queries = to_matrix(vectors)
+        with self.lock:
+            if not self.rows:
+                return [[] for _ in range(len(queries))]
+            if allowed is None:
+                return self._search_live(queries, k, self.index.search)
+            scores, rows = self._search_allowed(queries, k, self._filter(allowed))
+            return [self._hits(row_scores, row_ids, k) for row_scores, row_ids in zip(scores, rows)]
+
+    def _search_live(self, queries, k, search):
+        # Caller holds self.lock. search(queries, fetch) -> (scores, rows). Tombstones are dropped from the hits, so
+        # with any of them 2k rows are fetched, twice as many again while a query comes up short, and not one more
+        # per tombstone. A query that got -1 rows has run out of rows to return and asking for more will not help
+        fetch = min(2 * k if self.tombstones else k, len(self.ids))
+        while True:
+            scores, rows = search(queries, fetch)
+            hits = [self._hits(row_scores, row_ids, k) for row_scores, row_ids in zip(scores, rows)]
+            if fetch == len(self.ids) or all(len(query_hits) == k or -1 in row_ids for query_hits, row_ids in zip(hits, rows)):
+                return hits
+            fetch = min(2 * fetch, len(self.ids))
+
+    def _search_allowed(self, queries, k, selection):
+        # Caller holds self.lock. Allowed rows are never tombstones, k of them are enough
+        rows = selection['rows']
+        subset = len(rows) <= SUBSET_SHARE * len(self.ids)
+        if isinstance(self.index, faiss.IndexHNSW):
+            subset = (subset and len(rows) <= HNSW_EXACT_ROWS) or len(rows) < HNSW_MIN_SHARE * len(self.ids)
+        elif not isinstance(self.index, faiss.IndexFlat):
+            # Decoding sq8 or ivfpq rows on every query costs more than a filtered scan of the codes, only sets small
+            # enough to keep their decoded vectors are scored apart
+            subset = len(rows) <= EXACT_FILTER_ROWS
+        if subset:
+            vectors = selection.get('vectors')
+            if vectors is None:
+                vectors = self.index.reconstruct_batch(rows) if len(rows) else np.zeros((0, self.dim), dtype='float32')
+                if len(rows) <= EXACT_FILTER_ROWS:
+                    selection['vectors'] = vectors
+            scores, found = exact_top_k([vectors], queries, min(k, len(rows)))
+            return scores, rows[found]
+        if 'params' not in selection:
+            # The selector points into the bitmap, it is kept alive next to it
+            selection['bitmap'] = np.packbits(row_mask(rows, len(self.ids)), bitorder='little')
+            selector = faiss.IDSelectorBitmap(len(self.ids), faiss.swig_ptr(selection['bitmap']))
+            selection['params'] = filtered_search_params(self.index, selector)
+        return self.index.search(queries, min(k, len(rows)), params=selection['params'])
+
+    def _meta(self):
+        # Caller holds self.lock
+        return {
+            'version': INDEX_VERSION,
+            'kind': self.kind,
+            'model_name': self.model_name,
+            'dim': self.dim,
+            'ntotal': len(self.ids),
+            'ids': self.ids,
+            'hashes': self.hashes,
+            'tombstones': sorted(self.tombstones),
+        }
+
+    def save(self, index_dir, extra_meta=None):
+        os.makedirs(index_dir, exist_ok=True)
+        with self.lock:
+            # Write to temp files and swap in so a crash never leaves a half written index
+            index_path = os.path.join(index_dir, INDEX_FILENAME)
+            faiss.write_index(self.index, index_path + '.tmp')
+            os.replace(index_path + '.tmp', index_path)
+            write_meta(index_dir, {**self._meta(), **(extra_meta or {})})
+
+    @classmethod
+    def load(cls, index_dir, meta):
+        try:
+            index = faiss.read_index(os.path.join(index_dir, INDEX_FILENAME))
+        except RuntimeError:
+            return None
+        if index.ntotal != meta['ntotal'] or index.d != meta['dim']:
+            return None
+        return cls(meta['dim'], meta['model_name'], index=index, ids=meta['ids'], hashes=meta['hashes'], kind=meta['kind'],
+                   tombstones=meta.get('tombstones'))
+
+    def changes(self, notes):
+        # Returns ({note_id: text} new or changed since they were indexed, [note_id, ...] indexed but gone from notes)
+        with self.lock:
+            changed = {note_id: text for note_id, text in notes.items() if self.hashes.get(note_id) != note_hash(text)}
+            removed = [note_id for note_id in self.rows if note_id not in notes]
+        return changed, removed
+
+
+def row_mask(rows, count):
+    mask = np.zeros(count, dtype=bool)
+    mask[rows] = True
+    return mask
+
+
+def gather_rows(blocks, rows):
+    # float32 copy of the given sorted rows of a list of float16/float32 matrices
+    ends = np.cumsum([len(block) for block in blocks])
+    which = np.searchsorted(ends, rows, side='right')
+    parts = [np.asarray(blocks[block][rows[which == block] - (ends[block] - len(blocks[block]))], dtype='float32')
+             for block in np.unique(which)]
+    return np.concatenate(parts) if parts else np.zeros((0, blocks[0].shape[1]), dtype='float32')
+
+
+def block_chunks(blocks):
+    # (float32 chunk, its row numbers) over a list of matrices
+    offset = 0
+    for block in blocks:
+        for start in range(0, len(block), SEARCH_CHUNK):
+            chunk = np.asarray(block[start:start + SEARCH_CHUNK], dtype='float32')
+            yield chunk, np.arange(offset + start, offset + start + len(chunk))
+        offset += len(block)
+
+
+def exact_top_k(blocks, queries, k, rows=None, mask=None):
+    # Top k rows by inner product over a list of float16/float32 matrices, returns (scores, rows) best first.
+    # Goes a chunk at a time so float16 is converted to float32 in pieces and only k candidates per query are kept.
+    # With rows (sorted row numbers) only those rows are scored, with mask (a bool per row) only rows set in it
+    # can be returned
+    top_scores = np.empty((len(queries), 0), dtype='float32')
+    top_rows = np.empty((len(queries), 0), dtype='int64')
+    if rows is None:
+        chunks = block_chunks(blocks)
+    else:
+        chunks = ((gather_rows(blocks, rows[start:start + SEARCH_CHUNK]), rows[start:start + SEARCH_CHUNK])
+                  for start in range(0, len(rows), SEARCH_CHUNK))
+    for chunk, chunk_rows in chunks:
+        scores = queries @ chunk.T
+        if mask is not None:
+            scores[:, ~mask[chunk_rows]] = -np.inf
+        scores = np.concatenate([top_scores, scores], axis=1)
+        chunk_rows = np.concatenate([top_rows, np.broadcast_to(chunk_rows, (len(queries), len(chunk_rows)))], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            chunk_rows = np.take_along_axis(chunk_rows, keep, axis=1)
+        top_scores, top_rows = scores, chunk_rows
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_rows, order, axis=1)
+
+
+class NumpyIndex(NotesIndex):
+    '''Exact search with NumPy over vectors memory-mapped from vectors.npy'''
+
+    def __init__(self, dim, model_name, matrix=None, ids=None, hashes=None, kind='npy16', tombstones=None):
+        self.dim = dim
+        self.model_name = model_name
+        self.kind = kind
+        self.dtype = NUMPY_KINDS[kind]
+        # The saved matrix (a read-only memmap) plus rows added since, searched in that order
+        self.blocks = [matrix] if matrix is not None and len(matrix) else []
+        self._set_rows(ids, hashes, tombstones)
+        self.lock = threading.Lock()
+
+    def add(self, ids, texts, vectors):
+        rows = to_matrix(vectors)
+        check_dim(self.dim, rows)
+        rows = rows.astype(self.dtype)
+        with self.lock:
+            # A new list, so searches that already took the old one are not affected
+            self.blocks = self.blocks + [rows]
+            self._add_rows(ids, texts)
+
+    def search_many(self, vectors, k=4, allowed=None):
+        queries = to_matrix(vectors)
+        with self.lock:
+            blocks = self.blocks
+            count = len(self.ids)
+            selection = self._filter(allowed) if allowed is not None and count else None
+            if selection is not None:
+                allowed_rows = selection['rows']
+                if len(allowed_rows) > SUBSET_SHARE * count:
+                    if 'mask' not in selection:
+                        selection['mask'] = row_mask(allowed_rows, count)
+                elif len(allowed_rows) <= EXACT_FILTER_ROWS and 'vectors' not in selection:
+                    selection['vectors'] = gather_rows(blocks, allowed_rows)
+        if not count:
+            return [[] for _ in range(len(queries))]
+        if selection is None:
+            with self.lock:
+                return self._search_live(queries, k, lambda queries, fetch: exact_top_k(blocks, queries, fetch))
+        if 'vectors' in selection:
+            scores, found = exact_top_k([selection['vectors']], queries, min(k, len(allowed_rows)))
+            rows = allowed_rows[found]
+        elif 'mask' in selection:
+            scores, rows = exact_top_k(blocks, queries, min(k, len(allowed_rows)), mask=selection['mask'])
+        else:
+            scores, rows = exact_top_k(blocks, queries, min(k, len(allowed_rows)), allowed_rows)
+        with self.lock:
+            return [self._hits(row_scores, row_ids, k) for row_scores, row_ids in zip(scores, rows)]
+
+    def save(self, index_dir, extra_meta=None):
+        os.makedirs(index_dir, exist_ok=True)
+        with self.lock:
+            # Rewrites the whole matrix, then maps the new file in place of the blocks
+            vectors_path = os.path.join(index_dir, VECTORS_FILENAME)
+            if not self.ids:
+                with open(vectors_path + '.tmp', 'wb') as file:
+                    np.save(file, np.zeros((0, self.dim), dtype=self.dtype))
+                os.replace(vectors_path + '.tmp', vectors_path)
+                write_meta(index_dir, {**self._meta(), **(extra_meta or {})})
+                return
+            matrix = np.lib.format.open_memmap(vectors_path + '.tmp', mode='w+', dtype=self.dtype, shape=(len(self.ids), self.dim))
+            offset = 0
+            for block in self.blocks:
+                matrix[offset:offset + len(block)] = block
+                offset += len(block)
+            matrix.flush()
+            del matrix
+            os.replace(vectors_path + '.tmp', vectors_path)
+            write_meta(index_dir, {**self._meta(), **(extra_meta or {})})
+            self.blocks = [np.load(vectors_path, mmap_mode='r')]
+
+    @classmethod
+    def load(cls, index_dir, meta):
+        # Maps the file, nothing is read until a search touches it
+        try:
+            matrix = np.load(os.path.join(index_dir, VECTORS_FILENAME), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if matrix.shape != (meta['ntotal'], meta['dim']) or matrix.dtype != NUMPY_KINDS[meta['kind']]:
+            return None
+        return cls(meta['dim'], meta['model_name'], matrix=matrix, ids=meta['ids'], hashes=meta['hashes'], kind=meta['kind'],
+                   tombstones=meta.get('tombstones'))
+
+
+class PassageIndex:
+    '''Note level searches over a NotesIndex or NumpyIndex of passages'''
+
+    def __init__(self, index, note_hashes=None):
+        self.index = index
+        self.model_name = index.model_name
+        self.kind = index.kind
+        self.dim = index.dim
+        self.shards = index.shards
+        # Content hash of every indexed note, and the passage ids it is indexed as
+        self.hashes = dict(note_hashes or {})
+        self.passages = {}
+        for item in index.rows:
+            self.passages.setdefault(note_passages.parse_passage_id(item)[0], []).append(item)
+        # Passage ids of recent allowed note sets, valid while version is unchanged
+        self.version = 0
+        self.filters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def upsert(self, notes, embeddings):
+        # Only passages that are new or whose text changed are embedded and added, ones no longer there are removed
+        check_embeddings(self.model_name, embeddings)
+        new_ids, new_texts, removed, note_ids = [], [], [], {}
+        with self.lock:
+            for note_id, text in notes.items():
+                items = []
+                for start, end in note_passages.split_passages(text):
+                    item = note_passages.passage_id(note_id, start, end)
+                    items.append(item)
+                    if self.index.hashes.get(item) != note_hash(text[start:end]):
+                        new_ids.append(item)
+                        new_texts.append(text[start:end])
+                note_ids[note_id] = items
+                kept = set(items)
+                removed += [item for item in self.passages.get(note_id, []) if item not in kept]
+        # Embedded before anything changes, so a failed model call leaves the index as it was
+        if new_ids:
+            self.index.add(new_ids, new_texts, embeddings.embed_documents(new_texts))
+        for item in removed:
+            self.index.remove(item)
+        with self.lock:
+            for note_id, items in note_ids.items():
+                self.passages[note_id] = items
+                self.hashes[note_id] = note_hash(notes[note_id])
+            self.version += 1
+
+    def remove(self, note_id):
+        with self.lock:
+            items = self.passages.pop(note_id, [])
+            found = self.hashes.pop(note_id, None) is not None
+            self.version += 1
+        for item in items:
+            self.index.remove(item)
+        return found
+
+    def tombstone_ratio(self):
+        return self.index.tombstone_ratio()
+
+    def search(self, vector, k=4, allowed=None):
+        return self.search_many(vector, k, allowed)[0]
+
+    def search_many(self, vectors, k=4, allowed=None):
+        return [[(note_id, score) for note_id, score, _, _ in hits] for hits in self.search_passages_many(vectors, k, allowed)]
+
+    def search_passages(self, vector, k=4, allowed=None):
+        # Returns [(note_id, score, start, end), ...], the best passage of each of the k best notes
+        return self.search_passages_many(vector, k, allowed)[0]
+
+    def _items(self, allowed):
+        # The passage ids of the allowed notes, the same frozenset each time so the inner index reuses its cached rows
+        with self.lock:
+            cached = self.filters.get(allowed)
+            if cached is None or cached[0] != self.version:
+                cached = self.filters[allowed] = (self.version, frozenset(
+                    item for note_id in allowed for item in self.passages.get(note_id, ())))
+            self.filters.move_to_end(allowed)
+            if len(self.filters) > MAX_FILTERS:
+                self.filters.popitem(last=False)
+            return cached[1]
+
+    def search_passages_many(self, vectors, k=4, allowed=None):
+        queries = to_matrix(vectors)
+        items = self._items(allowed) if allowed is not None else None
+        rows = len(self.index) if items is None else len(items)
+        # A note can fill several of the top rows, fetch more until there are k notes or nothing left
+        fetch = 4 * k
+        while True:
+            results = [self._best_passages(hits, k) for hits in self.index.search_many(queries, fetch, items)]
+            if fetch >= rows or all(len(hits) == k for hits in results):
+                return results
+            fetch *= 4
+
+    def _best_passages(self, hits, k):
+        notes = []
+        seen = set()
+        for item, score in hits:
+            note_id, start, end = note_passages.parse_passage_id(item)
+            if note_id not in seen:
+                seen.add(note_id)
+                notes.append((note_id, score, start, end))
+                if len(notes) == k:
+                    break
+        return notes
+
+    def save(self, index_dir):
+        with self.lock:
+            hashes = dict(self.hashes)
+        self.index.save(index_dir, {'passages': note_passages.PASSAGES_VERSION, 'note_hashes': hashes})
+
+    @classmethod
+    def load(cls, index_class, index_dir, meta):
+        index = index_class.load(index_dir, meta)
+        return cls(index, meta['note_hashes']) if index is not None else None
+
+    def changes(self, notes):
+        with self.lock:
+            changed = {note_id: text for note_id, text in notes.items() if self.hashes.get(note_id) != note_hash(text)}
+            removed = [note_id for note_id in self.hashes if note_id not in notes]
+        return changed, removed
+
+
+def write_meta(index_dir, meta):
+    meta_path = os.path.join(index_dir, META_FILENAME)
+    with open(meta_path + '.tmp', 'w') as file:
+        json.dump(meta, file)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def load_index(index_dir, model_name, kind=None, passages=False, shards=None):
+    # Returns None when there is no usable index on disk, or it is not of the asked for kind, passages or shards setting
+    try:
+        with open(os.path.join(index_dir, META_FILENAME), 'r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != INDEX_VERSION or meta.get('model_name') != model_name:
+        return None
+    if meta.get('kind') not in INDEX_KINDS or (kind is not None and meta['kind'] != kind):
+        return None
+    if meta.get('shards') != shards:
+        return None
+    if not shards and meta['ntotal'] != len(meta['ids']):
+        return None
+    if meta.get('passages') != (note_passages.PASSAGES_VERSION if passages else None):
+        return None
+    if shards:
+        import sharded_index
+        index_class = sharded_index.ShardedIndex
+    else:
+        index_class = NumpyIndex if meta['kind'] in NUMPY_KINDS else NotesIndex
+    if passages:
+        return PassageIndex.load(index_class, index_dir, meta)
+    return index_class.load(index_dir, meta)
+
+
+def build_index(notes, embeddings, model_name, kind=None, passages=False, shards=None):
+    if passages:
+        texts = {}
+        for note_id, text in notes.items():
+            for start, end in note_passages.split_passages(text):
+                texts[note_passages.passage_id(note_id, start, end)] = text[start:end]
+        return PassageIndex(build_index(texts, embeddings, model_name, kind, shards=shards),
+                            {note_id: note_hash(text) for note_id, text in notes.items()})
+    check_embeddings(model_name, embeddings)
+    ids = list(notes.keys())
+    texts = [notes[note_id] for note_id in ids]
+    matrix = to_matrix(embeddings.embed_documents(texts))
+    if shards:
+        import sharded_index
+        index = sharded_index.ShardedIndex(matrix.shape[1], model_name, shards, kind or 'npy32')
+        index.add(ids, texts, matrix)
+        return index
+    kind = kind or choose_index_kind(len(ids))
+    if not can_train(kind, len(ids)):
+        # Too few notes to train on yet, the next rebuild of the asked for kind trains on more
+        kind = 'flat'
+    if kind in NUMPY_KINDS:
+        index = NumpyIndex(matrix.shape[1], model_name, kind=kind)
+        index.add(ids, texts, matrix)
+        return index
+    faiss_index = make_faiss_index(kind, matrix.shape[1], len(ids))
+    train(faiss_index, matrix)
+    index = NotesIndex(matrix.shape[1], model_name, index=faiss_index, kind=kind)
+    index.add(ids, texts, matrix)
+    return index
+
+
+def add_notes(index, notes, embeddings, index_dir):
+    # notes is {note_id: text} of notes that are new or changed since they were indexed
+    if not notes:
+        return
+    index.upsert(notes, embeddings)
+    index.save(index_dir)
+
+
+def needs_compaction(index, max_tombstone_ratio=MAX_TOMBSTONE_RATIO):
+    return index.tombstone_ratio() > max_tombstone_ratio and len(index) > 0
+
+
+def compact_index(index, notes, embeddings):
+    # A new index of the same kind over only the current notes, their vectors come from the embedding cache
+    return build_index(notes, embeddings, index.model_name, index.kind, isinstance(index, PassageIndex), index.shards)
+
+
+def load_or_build(notes, embeddings, index_dir, model_name, kind=None, passages=False, shards=None, read_only=False):
+    # Returns None when there are no notes to index yet, kind=None keeps whatever kind is on disk.
+    # Notes edited or deleted since the index was saved are re-embedded or tombstoned, not rebuilt.
+    # With read_only the index is only brought up to date in memory, the process holding the note log's lock saves it
+    index = load_index(index_dir, model_name, kind, passages, shards)
+    if index is not None:
+        changed, removed = index.changes(notes)
+        for note_id in removed:
+            index.remove(note_id)
+        if needs_compaction(index) and notes:
+            index = compact_index(index, notes, embeddings)
+        elif changed:
+            index.upsert(changed, embeddings)
+        elif not removed:
+            return index
+    elif notes:
+        index = build_index(notes, embeddings, model_name, kind, passages, shards)
+    else:
+        return None
+    if not read_only:
+        index.save(index_dir)
+    return index
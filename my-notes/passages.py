@@ -0,0 +1,123 @@
+'''
+Split notes into passages for the vector index.
+
+Notes run to several KB and all-MiniLM-L6-v2 only reads the first 256 word
+pieces of what it embeds, so a note embedded whole is mostly left out of the
+index. split_passages() cuts a note at markdown headings and around code
+fences, then cuts anything still longer than PASSAGE_CHARS at a paragraph,
+line, sentence or word break. A heading counts whether or not it starts a
+line, since pasted notes lose their line breaks, but inside a code fence #
+is a comment and not a heading.
+
+Passages are (start, end) offsets into the note, and are keyed in the index
+as "<note id>#<start>-<end>" so a hit maps straight back to its note and span.
+Bump PASSAGES_VERSION whenever split_passages() output changes, saved passage
+indexes are rebuilt then.
+'''
+import re
+
+import lexical
+
+PASSAGES_VERSION = 1
+# About 200 word pieces of prose, code takes more per character
+PASSAGE_CHARS = 800
+# A shorter passage (a lone heading) is merged into the one after it
+MIN_PASSAGE_CHARS = 200
+
+FENCE = re.compile(r'```')
+HEADING = re.compile(r'(?<!\S)#{1,6} (?=\S)')
+# Where to cut an overlong passage, best first
+BREAKS = [re.compile(pattern) for pattern in (r'\n\s*\n', r'\n', r'[.!?;:](?=\s)', r'\s')]
+
+
+def passage_id(note_id, start, end):
+    return f'{note_id}#{start}-{end}'
+
+
+def parse_passage_id(item):
+    # Returns (note_id, start, end)
+    note_id, _, span = item.rpartition('#')
+    start, _, end = span.partition('-')
+    return note_id, int(start), int(end)
+
+
+def fence_ranges(text):
+    # (start, end) of every code fence, markers included. An unclosed fence runs to the end of the note
+    ranges = []
+    opened = None
+    for match in FENCE.finditer(text):
+        if opened is None:
+            opened = match.start()
+        else:
+            ranges.append((opened, match.end()))
+            opened = None
+    if opened is not None:
+        ranges.append((opened, len(text)))
+    return ranges
+
+
+def _cut_long(text, start, end, max_chars):
+    while end - start > max_chars:
+        cut = start + max_chars
+        for pattern in BREAKS:
+            # The last break in the window, but not so early that it leaves a sliver
+            breaks = [match.end() for match in pattern.finditer(text, start + max_chars // 2, start + max_chars)]
+            if breaks:
+                cut = breaks[-1]
+                break
+        yield start, cut
+        start = cut
+    yield start, end
+
+
+def _strip(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def split_passages(text, max_chars=PASSAGE_CHARS, min_chars=MIN_PASSAGE_CHARS):
+    # Returns [(start, end), ...] in order, covering all of the note but surrounding whitespace
+    cuts = {0, len(text)}
+    prose = 0
+    for start, end in fence_ranges(text):
+        cuts.update(match.start() for match in HEADING.finditer(text, prose, start))
+        cuts.update((start, end))
+        prose = end
+    cuts.update(match.start() for match in HEADING.finditer(text, prose))
+    cuts = sorted(cuts)
+
+    passages = []
+    for section_start, section_end in zip(cuts, cuts[1:]):
+        for start, end in _cut_long(text, section_start, section_end, max_chars):
+            start, end = _strip(text, start, end)
+            if start == end:
+                continue
+            if passages and passages[-1][1] - passages[-1][0] < min_chars and end - passages[-1][0] <= max_chars:
+                passages[-1] = (passages[-1][0], end)
+            else:
+                passages.append((start, end))
+    return passages
+
+
+def expand_to_fences(text, start, end):
+    # Widens a span cut out of a long code fence to the whole fence, so it renders as code
+    for fence_start, fence_end in fence_ranges(text):
+        if fence_start < start < fence_end:
+            start = fence_start
+        if fence_start < end < fence_end:
+            end = fence_end
+    return start, end
+
+
+def keyword_span(text, query):
+    # The passage with the most occurrences of the query's words, for hits the vector index didn't rank
+    terms = set(lexical.tokenize(query))
+    best, best_count = None, 0
+    for start, end in split_passages(text):
+        count = sum(token in terms for token in lexical.tokenize(text[start:end]))
+        if count > best_count:
+            best, best_count = (start, end), count
+    return best
@@ -0,0 +1,69 @@
+'''
+Cache of query results.
+
+The same few questions get asked over and over, and each one costs a model
+call for the query embedding plus both searches. QueryCache keeps results by
+cache_key(): the normalized query text, the retrieval settings and the index
+generation. The ingest worker bumps its generation whenever a batch is
+indexed or a note is deleted, so results from before a change are never
+looked up again and age out of the LRU.
+
+Entries also expire after ttl_seconds. Every entry remembers how long the
+search took, and a hit adds that to saved_seconds.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    # The embedding model and BM25 both ignore case and extra whitespace
+    return ' '.join(query.lower().split())
+
+
+def cache_key(query, generation, **params):
+    return (normalize_query(query), generation, tuple(sorted(params.items())))
+
+
+class QueryCache:
+    '''LRU cache of search results with a time to live, shared by every session'''
+
+    def __init__(self, max_entries=512, ttl_seconds=600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (result, seconds it took, time it was stored)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns the cached result, or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[2] > self.ttl_seconds:
+                del self.entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[1]
+            return entry[0]
+
+    def put(self, key, result, seconds):
+        with self.lock:
+            self.entries[key] = (result, seconds, time.time())
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'saved_ms': 1000 * self.saved_seconds}
@@ -0,0 +1,141 @@
+'''
+Query the saved notes without the Streamlit page.
+
+    python query_notes.py queries.txt --k 10 > results.jsonl
+    cat queries.jsonl | python query_notes.py --text --out results.jsonl
+    python query_notes.py queries.txt --tag bigquery --source file --after 2024-06-01
+
+Input is one query per line, either plain text or a JSON object with a
+"query" field; any other fields (ids, expected notes) are copied into that
+query's output line. Output is one JSON line per query, in input order:
+    {"query": "...", "path": "hybrid", "hits": [{"id": "12", "score": 0.03}, ...]}
+
+The notes, the vector and keyword indexes and the model are loaded once, and
+queries are embedded and searched in batches, so thousands of queries cost
+about as much as a few model calls. --tag, --source, --after and --before
+search only the notes with all of those #tags, from any of those sources and
+created in that range (see note_filters.py). From python:
+
+    from query_notes import open_searcher
+    searcher = open_searcher()
+    searcher.search_many(['how do I refresh a materialized view', 'GBQDataRetriever'], k=5)
+'''
+import sys
+import json
+import time
+import argparse
+
+import config
+import lexical
+import retrieval
+import note_log
+import notes_index
+import note_filters
+import warm_model
+from embedding_cache import EmbeddingCache
+
+
+class NotesSearcher:
+    '''Notes, indexes and embedding model loaded once for many queries'''
+
+    def __init__(self, notes, vector_index, lexical_index, embeddings):
+        # notes is anything with get(note_id), a NoteLog reads only the hits' texts from its body file
+        self.notes = notes
+        self.vector_index = vector_index
+        self.lexical_index = lexical_index
+        self.embeddings = embeddings
+
+    def _result(self, query, hits, path, text):
+        result = {'query': query, 'path': path, 'hits': [{'id': note_id, 'score': score} for note_id, score in hits]}
+        if text:
+            for hit in result['hits']:
+                hit['text'] = self.notes.get(hit['id'])
+        return result
+
+    def search(self, query, k=4, text=False, allowed=None):
+        hits, path = retrieval.search(query, self.vector_index, self.lexical_index, self.embeddings, k, allowed=allowed)
+        return self._result(query, hits, path, text)
+
+    def search_many(self, queries, k=4, batch_size=64, text=False, allowed=None):
+        results = retrieval.search_many(queries, self.vector_index, self.lexical_index, self.embeddings, k, batch_size,
+                                        allowed)
+        return [self._result(query, hits, path, text) for query, (hits, path) in zip(queries, results)]
+
+
+def open_searcher(model_name=config.EMBEDDING_MODEL_NAME):
+    # Writes nothing, not the note log, the embedding cache or the index, so it can run next to the app or the folder
+    # watcher. Notes they have not indexed yet are embedded here and kept in memory
+    log = note_log.open_notes(config.NOTES_FILEPATH, config.NOTES_LOG_FILEPATH, config.NOTES_SNAPSHOT_FILEPATH, read_only=True)
+    notes = log.copy_notes()
+    embeddings = EmbeddingCache(warm_model.get_model(model_name), model_name, config.EMBEDDINGS_DIR, read_only=True)
+    vector_index = notes_index.load_or_build(notes, embeddings, config.INDEX_DIR, model_name, config.INDEX_KIND, config.PASSAGES,
+                                           config.SHARDS, read_only=True)
+    return NotesSearcher(log, vector_index, lexical.build_lexical_index(notes), embeddings)
+
+
+def open_filters(log):
+    # Tag, source and month bitmaps of every note, for --tag/--source/--after/--before
+    return note_filters.build_filter_index(log.copy_notes(), log.copy_created(), log.copy_sources())
+
+
+def parse_day(value):
+    return time.mktime(time.strptime(value, '%Y-%m-%d')) if value else None
+
+
+def read_queries(file):
+    # Returns [(query, extra fields), ...], blank lines are skipped
+    queries = []
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            record = json.loads(line)
+            queries.append((record.pop('query'), record))
+        else:
+            queries.append((line, {}))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='?', help='query file, stdin by default')
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=64, help='queries per model call')
+    parser.add_argument('--text', action='store_true', help='include the note text of every hit')
+    parser.add_argument('--out', help='result file, stdout by default')
+    parser.add_argument('--tag', action='append', default=[], help='only notes with this #tag, repeat for several')
+    parser.add_argument('--source', action='append', default=[], choices=note_log.SOURCES, help='only notes from this source')
+    parser.add_argument('--after', help='only notes created on or after this YYYY-MM-DD')
+    parser.add_argument('--before', help='only notes created before this YYYY-MM-DD')
+    args = parser.parse_args()
+
+    if args.queries:
+        with open(args.queries, 'r') as file:
+            queries = read_queries(file)
+    else:
+        queries = read_queries(sys.stdin)
+
+    started = time.perf_counter()
+    searcher = open_searcher()
+    allowed = None
+    if args.tag or args.source or args.after or args.before:
+        allowed = open_filters(searcher.notes).select([tag.lstrip('#').lower() for tag in args.tag], args.source,
+                                                      parse_day(args.after), parse_day(args.before))
+    loaded = time.perf_counter()
+    results = searcher.search_many([query for query, _ in queries], args.k, args.batch_size, args.text, allowed)
+    finished = time.perf_counter()
+
+    out = open(args.out, 'w') if args.out else sys.stdout
+    try:
+        for (_, extra), result in zip(queries, results):
+            out.write(json.dumps({**extra, **result}) + '\n')
+    finally:
+        if args.out:
+            out.close()
+    print(f'{len(queries)} queries in {finished - loaded:.2f}s ({len(queries) / max(finished - loaded, 1e-9):.0f}/s), '
+          f'loading took {loaded - started:.2f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+'''
+Local query server: one warm model and index shared by every client.
+
+    python query_server.py                        # http://127.0.0.1:8765 over the saved notes
+    python query_server.py --window-ms 2 --max-batch 32
+    python query_server.py --synthetic 10000      # generated notes and the hashing embedder, for load tests
+    python query_server.py --synthetic 10000 --embedder model
+
+    curl -s localhost:8765/search -d '{"query": "refresh a materialized view", "k": 3}'
+    curl -s localhost:8765/stats
+
+POST /search takes {"query", "k" (default 4), "text" (default false)} and
+returns the same JSON as a line of query_notes.py, or a 400 for a query
+that is not a non-empty string or a k that is not an integer of at least
+1. GET /stats returns request and batch counts.
+
+Every request thread hands its query to a MicroBatcher and waits. The
+batcher thread takes the first waiting query, collects whatever else
+arrives within --window-ms (up to --max-batch), and answers the whole batch
+with one retrieval.search_many(), which is one model call and one faiss
+search. Requests for more than retrieval.CANDIDATES hits fuse that many
+candidates, they get a search_many() of their own. It stops waiting early once every caller is in the batch, so a lone
+query doesn't pay for the window. Under load, many queries share each model
+call.
+'''
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import retrieval
+from query_notes import NotesSearcher, open_searcher
+
+
+def request_error(query, k):
+    # Why a search can't be answered, or None. bool is an int too, but {"k": true} is not a number of hits
+    if not isinstance(query, str) or not query.strip():
+        return 'query must be a non-empty string'
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        return 'k must be an integer of at least 1'
+    return None
+
+
+class MicroBatcher:
+    '''Coalesces concurrent queries into one search_many() call'''
+
+    def __init__(self, searcher, window_ms=5, max_batch=64):
+        self.searcher = searcher
+        self.window_seconds = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.largest_batch = 0
+        # Callers waiting for an answer, a batch holding all of them has nothing left to wait for
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def search(self, query, k=4, timeout=60):
+        # Raises ValueError for a query it can't answer, before it can hold up a batch
+        error = request_error(query, k)
+        if error is not None:
+            raise ValueError(error)
+        request = {'query': query, 'k': k, 'done': threading.Event(), 'result': None, 'error': None}
+        with self.lock:
+            self.in_flight += 1
+        try:
+            self.queue.put(request)
+            if not request['done'].wait(timeout):
+                raise TimeoutError('query timed out')
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def stats(self):
+        return {'requests': self.requests, 'batches': self.batches, 'largest_batch': self.largest_batch,
+                'mean_batch': self.requests / self.batches if self.batches else 0.0, 'waiting': self.queue.qsize()}
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.window_seconds
+            while len(batch) < self.max_batch:
+                if self.queue.empty() and len(batch) >= self.in_flight:
+                    break
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._answer(batch)
+
+    def _answer(self, batch):
+        # Top k of a longer ranking is the same as searching with that k as long as both fuse as many candidates,
+        # so one search_many() serves every request with the same number of candidates
+        groups = {}
+        for request in batch:
+            groups.setdefault(max(retrieval.CANDIDATES, request['k']), []).append(request)
+        for group in groups.values():
+            self._answer_group(group)
+        self.requests += len(batch)
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+    def _answer_group(self, group):
+        try:
+            results = self.searcher.search_many([request['query'] for request in group], max(request['k'] for request in group))
+        except Exception as error:
+            if len(group) > 1:
+                # One bad query must not fail the others, each is answered on its own to find it
+                for request in group:
+                    self._answer_group([request])
+                return
+            group[0]['error'] = error
+            group[0]['done'].set()
+            return
+        for request, result in zip(group, results):
+            result['hits'] = result['hits'][:request['k']]
+            request['result'] = result
+            request['done'].set()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so load test clients don't pay for a new connection per query, and no Nagle delay on replies
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, self.server.batcher.stats())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/search':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            query = request['query']
+            k = request.get('k', 4)
+        except (ValueError, KeyError, TypeError):
+            self._send(400, {'error': 'expected {"query": "...", "k": 4}'})
+            return
+        error = request_error(query, k)
+        if error is not None:
+            self._send(400, {'error': error})
+            return
+        try:
+            result = self.server.batcher.search(query, k)
+        except Exception as error:
+            self._send(500, {'error': str(error)})
+            return
+        if request.get('text'):
+            for hit in result['hits']:
+                hit['text'] = self.server.batcher.searcher.notes.get(hit['id'])
+        self._send(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 128
+
+
+def make_server(searcher, host='127.0.0.1', port=8765, window_ms=5, max_batch=64):
+    server = QueryServer((host, port), QueryHandler)
+    server.batcher = MicroBatcher(searcher, window_ms, max_batch)
+    return server
+
+
+def synthetic_searcher(count, embedder='hashing'):
+    # Generated notes, so load tests don't need the saved notes
+    import tempfile
+    import lexical
+    import notes_index
+    import synthetic_notes
+    from bench_notes import open_embedder
+    from embedding_cache import EmbeddingCache
+
+    notes = {str(note_id): text for note_id, text in enumerate(synthetic_notes.generate_notes(count))}
+    model, model_name = open_embedder(embedder)
+    embeddings = EmbeddingCache(model, model_name, tempfile.mkdtemp(prefix='query-server-'))
+    vector_index = notes_index.build_index(notes, embeddings, model_name)
+    return NotesSearcher(notes, vector_index, lexical.build_lexical_index(notes), embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window-ms', type=float, default=5, help='how long a batch waits for more queries')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--synthetic', type=int, metavar='NOTES', help='serve generated notes instead of the saved ones')
+    parser.add_argument('--embedder', choices=['hashing', 'model'], default='hashing', help='embedder for --synthetic')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        searcher = synthetic_searcher(args.synthetic, args.embedder)
+    else:
+        searcher = open_searcher()
+        # Load the model now rather than on the first query
+        searcher.embeddings.embeddings.wait()
+    server = make_server(searcher, args.host, args.port, args.window_ms, args.max_batch)
+    print(f'serving {len(searcher.notes)} notes on http://{args.host}:{server.server_address[1]}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Hybrid retrieval over my notes.
+
+A query goes to both the FAISS index and the BM25 keyword index and the two
+rankings are merged with reciprocal rank fusion, so exact identifiers rank
+well without losing semantic matches. Pure keyword queries ("quoted" text,
+or only identifiers the keyword index knows) are answered by BM25 alone and
+never touch the embedding model.
+
+With a passage index, search() can also fill a spans dict with the offsets
+of the passage each note was found by, for highlighting.
+
+allowed, a frozenset of note ids from note_filters.FilterIndex.select(),
+restricts both indexes to those notes before they rank anything.
+'''
+import lexical
+import notes_index
+from timing import span
+
+# How many hits each index contributes to the fusion, at least k of them
+CANDIDATES = 20
+
+
+def search(query, vector_index, lexical_index, embeddings, k=4, timer=None, spans=None, allowed=None):
+    # Returns ([(note_id, score), ...], path) where path is 'keyword' or 'hybrid'.
+    # spans, if given, gets {note_id: (start, end)} of the best passage of notes the vector index found
+    if lexical_index is not None and lexical.is_keyword_query(query, lexical_index):
+        with span(timer, 'keyword search'):
+            hits = lexical_index.search(query.strip().strip('"'), k, allowed)
+        if hits:
+            return hits, 'keyword'
+
+    candidates = max(CANDIDATES, k)
+    rankings = []
+    if vector_index is not None:
+        with span(timer, 'embed query'):
+            vector = embeddings.embed_query(query)
+        with span(timer, 'vector search'):
+            if spans is not None and isinstance(vector_index, notes_index.PassageIndex):
+                hits = vector_index.search_passages(vector, candidates, allowed)
+                spans.update((note_id, (start, end)) for note_id, _, start, end in hits)
+                rankings.append([(note_id, score) for note_id, score, _, _ in hits])
+            else:
+                rankings.append(vector_index.search(vector, candidates, allowed))
+    if lexical_index is not None:
+        with span(timer, 'keyword search'):
+            rankings.append(lexical_index.search(query, candidates, allowed))
+    with span(timer, 'fuse results'):
+        return lexical.reciprocal_rank_fusion(rankings)[:k], 'hybrid'
+
+
+def search_many(queries, vector_index, lexical_index, embeddings, k=4, batch_size=64, allowed=None):
+    # Same results as search() for every query, but the embedding and vector search run once per batch
+    results = [None] * len(queries)
+    candidates = max(CANDIDATES, k)
+    semantic = []
+    for position, query in enumerate(queries):
+        if lexical_index is not None and lexical.is_keyword_query(query, lexical_index):
+            hits = lexical_index.search(query.strip().strip('"'), k, allowed)
+            if hits:
+                results[position] = (hits, 'keyword')
+                continue
+        semantic.append(position)
+
+    for start in range(0, len(semantic), batch_size):
+        positions = semantic[start:start + batch_size]
+        batch = [queries[position] for position in positions]
+        vector_hits = [[] for _ in batch]
+        if vector_index is not None:
+            vector_hits = vector_index.search_many(embeddings.embed_queries(batch), candidates, allowed)
+        for position, query, hits in zip(positions, batch, vector_hits):
+            rankings = [hits] if vector_index is not None else []
+            if lexical_index is not None:
+                rankings.append(lexical_index.search(query, candidates, allowed))
+            results[position] = (lexical.reciprocal_rank_fusion(rankings)[:k], 'hybrid')
+    return results
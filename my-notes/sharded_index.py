@@ -0,0 +1,295 @@
+'''
+Notes index split into shards, each searched by its own process.
+
+One index searched in the streamlit process uses one core for the Python
+side of every search and has to fit in that process. A ShardedIndex puts
+every row in one of N shards by a hash of its note id, so all passages of a
+note land in the same shard. Every shard is an ordinary NotesIndex or
+NumpyIndex saved in its own directory and served by a worker process:
+
+    my-notes-index/meta.json       - version, kind, model, dimension and shard count
+    my-notes-index/shard-00/       - meta.json and vectors.npy (or index.faiss) of shard 0
+    my-notes-index/shard-01/ ...
+
+A search sends the query batch to every worker at once, each returns its
+top k and the partial lists are merged into one ranking. Scores are cosine
+similarities in every shard, so the merge is exact, the same hits as one
+index over all rows. Adds and removes go only to the shard that owns the
+note. The npy kinds (npy32 by default) keep each shard memory-mapped, so a
+worker only holds the pages its searches touch.
+
+A filtered search (see note_filters.py) sends every shard its part of the
+allowed set once, kept by the worker under a key. Later searches with the
+same set only send the key, and shards with no allowed rows are skipped.
+
+Workers are started with one BLAS/OpenMP thread each, N shards use N cores.
+See bench_shards.py for how query throughput scales with the shard count.
+'''
+import os
+import zlib
+import heapq
+import shutil
+import collections
+import weakref
+import itertools
+import threading
+import multiprocessing
+
+import faiss
+
+import notes_index
+import warm_model
+
+# Kinds that can start empty in a worker, sq8 and ivfpq need training on the whole corpus
+SHARD_KINDS = ['flat', 'hnsw', 'npy16', 'npy32']
+SHARD_DIRNAME = 'shard-{:02d}'
+
+
+def shard_of(item, shards):
+    # Passage ids are note_id#start-end, a note and its passages share a shard
+    note_id = item.rpartition('#')[0] if '#' in item else item
+    return zlib.crc32(note_id.encode('utf-8')) % shards
+
+
+def shard_dir(index_dir, shard):
+    return os.path.join(index_dir, SHARD_DIRNAME.format(shard))
+
+
+def empty_index(dim, model_name, kind):
+    if kind in notes_index.NUMPY_KINDS:
+        return notes_index.NumpyIndex(dim, model_name, kind=kind)
+    return notes_index.NotesIndex(dim, model_name, kind=kind)
+
+
+def serve_shard(connection, path, dim, model_name, kind):
+    # Worker process: loads one shard (or starts it empty when path is None) and runs the methods it is sent
+    faiss.omp_set_num_threads(1)
+    index = empty_index(dim, model_name, kind) if path is None else notes_index.load_index(path, model_name, kind)
+    if index is None:
+        connection.send((False, None))
+        return
+    connection.send((True, index.hashes))
+    # Allowed sets of filtered searches, by the key ShardedIndex gave them
+    filters = {}
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        method, args = message
+        try:
+            if method == 'counts':
+                result = (len(index.ids), len(index.tombstones))
+            elif method == 'filter':
+                key, items = args
+                filters[key] = frozenset(items)
+                result = None
+            elif method == 'unfilter':
+                result = filters.pop(args[0], None) is not None
+            elif method == 'search_filtered':
+                queries, k, key = args
+                result = index.search_many(queries, k, filters[key])
+            else:
+                result = getattr(index, method)(*args)
+        except Exception as error:
+            connection.send((False, error))
+        else:
+            connection.send((True, result))
+
+
+def start_shards(shards, index_dir, dim, model_name, kind):
+    # spawn, not fork, the streamlit process has threads running
+    context = multiprocessing.get_context('spawn')
+    connections, processes = [], []
+    with warm_model.pinned_threads(1):
+        for shard in range(shards):
+            connection, child = context.Pipe()
+            path = shard_dir(index_dir, shard) if index_dir is not None else None
+            process = context.Process(target=serve_shard, args=(child, path, dim, model_name, kind),
+                                      name=f'shard-{shard}', daemon=True)
+            process.start()
+            child.close()
+            connections.append(connection)
+            processes.append(process)
+    return connections, processes
+
+
+def stop_shards(connections, processes):
+    for connection in connections:
+        try:
+            connection.send(None)
+        except OSError:
+            pass
+        connection.close()
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+
+class ShardedIndex:
+    '''Rows partitioned by note id hash over worker processes, one per shard'''
+
+    def __init__(self, dim, model_name, shards, kind='npy32', index_dir=None):
+        # Loads the shards saved in index_dir, or starts them empty. Raises OSError when a shard can't be loaded
+        if kind not in SHARD_KINDS:
+            raise ValueError(f'Index kind {kind!r} can not be sharded, expected one of {SHARD_KINDS}')
+        self.dim = dim
+        self.model_name = model_name
+        self.kind = kind
+        self.shards = shards
+        self.lock = threading.Lock()
+        self.connections, self.processes = start_shards(shards, index_dir, dim, model_name, kind)
+        # Stops the workers once the index is dropped, e.g. replaced by a compacted one
+        self._stop = weakref.finalize(self, stop_shards, self.connections, self.processes)
+        replies = [self._receive(connection) for connection in self.connections]
+        if not all(ok for ok, _ in replies):
+            self.close()
+            raise OSError(f'Could not load every shard in {index_dir}')
+        # Content hash of every row, and the shard it is in
+        self.hashes = {}
+        for _, hashes in replies:
+            self.hashes.update(hashes)
+        self.rows = {item: shard_of(item, shards) for item in self.hashes}
+        # Allowed sets already sent to the shards: allowed -> (version, key, shards that got part of it)
+        self.version = 0
+        self.filters = collections.OrderedDict()
+        self.filter_keys = itertools.count()
+
+    def _receive(self, connection):
+        try:
+            return connection.recv()
+        except EOFError:
+            return False, OSError('Shard worker exited')
+
+    def _call(self, calls):
+        # calls is {shard: (method, args)}, all sent before any reply is read so the shards work in parallel.
+        # Caller holds self.lock. Returns {shard: result}
+        for shard, call in calls.items():
+            self.connections[shard].send(call)
+        replies = {shard: self._receive(self.connections[shard]) for shard in calls}
+        for ok, result in replies.values():
+            if not ok:
+                raise result
+        return {shard: result for shard, (_, result) in replies.items()}
+
+    def _call_all(self, method, *args):
+        return self._call({shard: (method, args) for shard in range(self.shards)})
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, ids, texts, vectors):
+        matrix = notes_index.to_matrix(vectors)
+        notes_index.check_dim(self.dim, matrix)
+        groups = {}
+        for row, note_id in enumerate(ids):
+            groups.setdefault(shard_of(note_id, self.shards), []).append(row)
+        calls = {shard: ('add', ([ids[row] for row in rows], [texts[row] for row in rows], matrix[rows]))
+                 for shard, rows in groups.items()}
+        with self.lock:
+            self._call(calls)
+            for note_id, text in zip(ids, texts):
+                self.rows[note_id] = shard_of(note_id, self.shards)
+                self.hashes[note_id] = notes_index.note_hash(text)
+            self.version += 1
+
+    def upsert(self, notes, embeddings):
+        notes_index.check_embeddings(self.model_name, embeddings)
+        ids = list(notes.keys())
+        texts = [notes[note_id] for note_id in ids]
+        self.add(ids, texts, embeddings.embed_documents(texts))
+
+    def remove(self, note_id):
+        with self.lock:
+            shard = self.rows.pop(note_id, None)
+            self.hashes.pop(note_id, None)
+            if shard is None:
+                return False
+            self._call({shard: ('remove', (note_id,))})
+            self.version += 1
+            return True
+
+    def _filter(self, allowed):
+        # Caller holds self.lock. Returns (key, shards) of the allowed set, sending its parts to the shards first if needed
+        cached = self.filters.get(allowed)
+        if cached is not None and cached[0] == self.version:
+            self.filters.move_to_end(allowed)
+            return cached[1], cached[2]
+        if cached is not None:
+            self._unfilter(cached)
+        parts = {}
+        for item in allowed:
+            shard = self.rows.get(item)
+            if shard is not None:
+                parts.setdefault(shard, []).append(item)
+        key = next(self.filter_keys)
+        self._call({shard: ('filter', (key, items)) for shard, items in parts.items()})
+        self.filters[allowed] = (self.version, key, sorted(parts))
+        self.filters.move_to_end(allowed)
+        if len(self.filters) > notes_index.MAX_FILTERS:
+            self._unfilter(self.filters.popitem(last=False)[1])
+        return key, sorted(parts)
+
+    def _unfilter(self, cached):
+        _, key, shards = cached
+        self._call({shard: ('unfilter', (key,)) for shard in shards})
+
+    def tombstone_ratio(self):
+        with self.lock:
+            counts = self._call_all('counts').values()
+        rows = sum(count for count, _ in counts)
+        return sum(tombstones for _, tombstones in counts) / rows if rows else 0.0
+
+    def search(self, vector, k=4, allowed=None):
+        return self.search_many(vector, k, allowed)[0]
+
+    def search_many(self, vectors, k=4, allowed=None):
+        # Every shard returns its own top k per query, the best k of those are the global top k
+        queries = notes_index.to_matrix(vectors)
+        with self.lock:
+            if not self.rows:
+                return [[] for _ in range(len(queries))]
+            if allowed is None:
+                results = self._call_all('search_many', queries, k)
+            else:
+                key, shards = self._filter(allowed)
+                if not shards:
+                    return [[] for _ in range(len(queries))]
+                results = self._call({shard: ('search_filtered', (queries, k, key)) for shard in shards})
+        return [heapq.nlargest(k, itertools.chain(*hits), key=lambda hit: hit[1]) for hits in zip(*results.values())]
+
+    def save(self, index_dir, extra_meta=None):
+        os.makedirs(index_dir, exist_ok=True)
+        with self.lock:
+            self._call({shard: ('save', (shard_dir(index_dir, shard),)) for shard in range(self.shards)})
+            meta = {'version': notes_index.INDEX_VERSION, 'kind': self.kind, 'model_name': self.model_name, 'dim': self.dim,
+                    'shards': self.shards}
+            notes_index.write_meta(index_dir, {**meta, **(extra_meta or {})})
+        # Files of an unsharded index or of shards beyond the current count are no longer used
+        for name in (notes_index.INDEX_FILENAME, notes_index.VECTORS_FILENAME):
+            if os.path.exists(os.path.join(index_dir, name)):
+                os.remove(os.path.join(index_dir, name))
+        used = {SHARD_DIRNAME.format(shard) for shard in range(self.shards)}
+        for name in os.listdir(index_dir):
+            if name.startswith('shard-') and name not in used:
+                shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir, meta):
+        # The row hashes come from the shards themselves, they are saved before the top level meta.json
+        try:
+            return cls(meta['dim'], meta['model_name'], meta['shards'], meta['kind'], index_dir)
+        except (OSError, ValueError):
+            return None
+
+    def changes(self, notes):
+        with self.lock:
+            changed = {note_id: text for note_id, text in notes.items() if self.hashes.get(note_id) != notes_index.note_hash(text)}
+            removed = [note_id for note_id in self.rows if note_id not in notes]
+        return changed, removed
+
+    def close(self):
+        self._stop()
@@ -0,0 +1,91 @@
+'''
+Synthetic notes for benchmarks.
+
+Generates markdown notes that look like the ones in my-notes.json and the
+top level my-notes.py: a short intro, ### sections, numbered and bulleted
+lists, bold labels and python/sql/bash code blocks. Sizes range from a few
+hundred bytes to around 10 KB. The same seed always gives the same corpus.
+'''
+import random
+
+TOPICS = [
+    ('BigQuery', ['materialized view', 'partitioned table', 'query cache', 'slot usage', 'maximum_bytes_billed']),
+    ('async Python', ['event loop', 'coroutine', 'asyncio.gather', 'connection pool', 'await']),
+    ('AWS', ['Secrets Manager', 'IAM role', 'boto3 client', 'S3 bucket', 'Lambda timeout']),
+    ('FAISS', ['inner product', 'HNSW graph', 'product quantization', 'nprobe', 'flat index']),
+    ('Streamlit', ['session state', 'cache_resource', 'rerun', 'sidebar', 'fragment']),
+    ('PostgreSQL', ['vacuum', 'index scan', 'REFRESH MATERIALIZED VIEW', 'connection limit', 'WAL']),
+    ('Docker', ['multi stage build', 'layer cache', 'healthcheck', 'volume mount', 'entrypoint']),
+    ('testing', ['fixture', 'mocking', 'coverage', 'integration test', 'flaky test']),
+]
+WORDS = ('the a this that when you can should will data query table service request cost time memory '
+         'performance result value client server user cache index batch latency throughput error retry '
+         'config file process thread worker load write read update schema column row key limit').split()
+IDENTIFIERS = ['GBQDataRetriever', 'maximum_bytes_billed', 'run_query', 'get_secret_value', 'query_table',
+               'use_query_cache', 'sales_summary_mv', 'QueryJobConfig', 'service_account', 'load_credentials']
+
+
+def sentence(rng, topic, terms, words=12):
+    parts = [rng.choice(WORDS) for _ in range(rng.randint(words // 2, words))]
+    parts.insert(rng.randrange(len(parts)), rng.choice(terms))
+    if rng.random() < 0.3:
+        parts.insert(rng.randrange(len(parts)), f'`{rng.choice(IDENTIFIERS)}`')
+    if rng.random() < 0.2:
+        parts.insert(0, topic)
+    return ' '.join(parts).capitalize() + '.'
+
+
+def code_block(rng, terms):
+    language = rng.choice(['python', 'sql', 'bash'])
+    if language == 'python':
+        name = rng.choice(IDENTIFIERS)
+        lines = ['import json', 'from google.cloud import bigquery', '', f'class {name[0].upper()}{name[1:]}:',
+                 '    def __init__(self, client):', '        self.client = client', '']
+        for _ in range(rng.randint(1, 8)):
+            method = rng.choice(IDENTIFIERS).lower()
+            lines += [f'    def {method}(self, query, {rng.choice(WORDS)}=None):',
+                      f'        # {rng.choice(terms)}',
+                      '        result = self.client.query(query).result()',
+                      '        return [dict(row) for row in result]', '']
+    elif language == 'sql':
+        lines = ['SELECT', f'    {rng.choice(WORDS)},', f'    SUM({rng.choice(WORDS)}) AS total',
+                 'FROM', f'    `your_project.your_dataset.{rng.choice(IDENTIFIERS)}`',
+                 f"WHERE {rng.choice(WORDS)} = '{rng.choice(terms)}'", 'GROUP BY 1']
+    else:
+        lines = [f'pip install {rng.choice(["google-cloud-bigquery", "boto3", "faiss-cpu", "streamlit"])}',
+                 f'export {rng.choice(WORDS).upper()}_{rng.choice(WORDS).upper()}=1']
+    return f'```{language}\n' + '\n'.join(lines) + '\n```'
+
+
+def generate_note(rng):
+    topic, terms = rng.choice(TOPICS)
+    parts = [' '.join(sentence(rng, topic, terms) for _ in range(rng.randint(1, 3)))]
+    for section in range(rng.randint(1, 8)):
+        parts.append(f'### {rng.choice(terms).title()}')
+        if rng.random() < 0.5:
+            parts.append('\n'.join(f'{item + 1}. **{rng.choice(terms).title()}**: {sentence(rng, topic, terms)}'
+                                   for item in range(rng.randint(2, 5))))
+        else:
+            parts.append('\n'.join(f'- {sentence(rng, topic, terms)}' for _ in range(rng.randint(2, 5))))
+        if rng.random() < 0.4:
+            parts.append(code_block(rng, terms))
+    return '\n\n'.join(parts)
+
+
+def generate_notes(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield generate_note(rng)
+
+
+def generate_queries(count, seed=1):
+    # Half natural language questions, half exact identifiers or phrases
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        topic, terms = rng.choice(TOPICS)
+        if rng.random() < 0.5:
+            queries.append(f'how do I use {rng.choice(terms)} with {topic} {rng.choice(WORDS)}')
+        else:
+            queries.append(rng.choice(IDENTIFIERS + [term for term in terms if term.isupper() or '_' in term]))
+    return queries
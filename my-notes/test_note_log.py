@@ -0,0 +1,124 @@
+'''
+Tests for the note log, run from the my-notes directory with python -m pytest
+'''
+import os
+import json
+import threading
+
+import pytest
+
+import note_log
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'notes.log'), str(tmp_path / 'notes.snapshot.json'), str(tmp_path / 'notes.bodies')
+
+
+def open_log(paths):
+    return note_log.NoteLog(*paths)
+
+
+def test_replay_trims_a_torn_last_line(paths):
+    log = open_log(paths)
+    log.add('first note')
+    log.add('second note')
+    log.close()
+    # A crash halfway through writing the third record
+    with open(paths[0], 'ab') as file:
+        file.write(b'{"seq": 3, "op": "add", "id": "2", "te')
+
+    log = open_log(paths)
+    assert log.copy_notes() == {'0': 'first note', '1': 'second note'}
+    assert log.add('third note') == ('2', True)
+    log.close()
+
+    with open(paths[0], 'rb') as file:
+        records = [json.loads(line) for line in file]
+    assert [record['seq'] for record in records] == [1, 2, 3]
+    log = open_log(paths)
+    assert log.copy_notes() == {'0': 'first note', '1': 'second note', '2': 'third note'}
+    log.close()
+
+
+def test_concurrent_adds_get_distinct_ids_and_all_survive(paths):
+    log = open_log(paths)
+    threads_count, per_thread = 8, 50
+
+    def add_notes(thread):
+        for number in range(per_thread):
+            log.add(f'note {number} of thread {thread}')
+
+    threads = [threading.Thread(target=add_notes, args=(thread,)) for thread in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    notes = log.copy_notes()
+    log.close()
+    assert len(notes) == threads_count * per_thread
+
+    with open(paths[0], 'rb') as file:
+        seqs = [json.loads(line)['seq'] for line in file]
+    assert seqs == list(range(1, threads_count * per_thread + 1))
+    log = open_log(paths)
+    assert log.copy_notes() == notes
+    log.close()
+
+
+def test_compaction_rewrites_the_body_file(paths):
+    log = open_log(paths)
+    for number in range(20):
+        log.add(f'note number {number} ' + 'text ' * 50)
+    log.compact()
+    first_bodies = log.bodies.path
+    assert os.path.exists(first_bodies)
+    assert os.path.getsize(paths[0]) == 0
+
+    # Most bodies are dead after these, the next compaction copies the live ones to a new file
+    for number in range(15):
+        log.delete(str(number))
+    log.update('19', 'note 19 edited')
+    log.compact()
+    assert log.bodies.path != first_bodies
+    assert not os.path.exists(first_bodies)
+    notes = log.copy_notes()
+    log.close()
+
+    assert sorted(notes, key=int) == ['15', '16', '17', '18', '19']
+    assert notes['19'] == 'note 19 edited'
+    log = open_log(paths)
+    assert log.copy_notes() == notes
+    log.close()
+
+
+def test_deleted_ids_are_not_reused_after_a_snapshot(paths):
+    log = open_log(paths)
+    log.add('zero')
+    log.add('one')
+    log.add('two')
+    log.delete('2')
+    log.compact()
+    log.close()
+
+    log = open_log(paths)
+    assert log.get('2') is None
+    assert log.add('three') == ('3', True)
+    log.close()
+
+
+def test_a_second_writer_is_refused_and_readers_are_not(paths):
+    log = open_log(paths)
+    log.add('zero')
+    with pytest.raises(note_log.NoteLogLocked):
+        open_log(paths)
+    reader = note_log.NoteLog(*paths, read_only=True)
+    assert reader.copy_notes() == {'0': 'zero'}
+    with pytest.raises(ValueError):
+        reader.add('one')
+    reader.close()
+    log.close()
+
+    log = open_log(paths)
+    assert log.add('one') == ('1', True)
+    log.close()
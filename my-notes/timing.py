@@ -0,0 +1,124 @@
+'''
+Timing spans for each streamlit script run.
+
+Every rerun of the notes page gets a RunTimer, and each stage (loading the
+note log, the model, the index, rendering notes, embedding the query,
+searching, formatting the result) is wrapped in a span. Finished runs go to a
+process-wide TimingHistory that keeps the last runs for the sidebar panel and
+exports them as JSONL or as a Chrome trace (load it in chrome://tracing or
+ui.perfetto.dev).
+
+A span costs two perf_counter() calls and a list append, and span(None, ...)
+does nothing, so library code can take an optional timer.
+'''
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class RunTimer:
+    def __init__(self, name='run'):
+        self.name = name
+        self.wall_time = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.spans.append({
+                'name': name,
+                'start_ms': 1000 * (start - self.started),
+                'duration_ms': 1000 * (time.perf_counter() - start),
+                'depth': self.depth,
+            })
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def total_ms(self):
+        return 1000 * (time.perf_counter() - self.started)
+
+    def stages(self):
+        # {stage: total ms} in the order stages started
+        totals = {}
+        for item in sorted(self.spans, key=lambda item: item['start_ms']):
+            totals[item['name']] = totals.get(item['name'], 0.0) + item['duration_ms']
+        return totals
+
+
+@contextmanager
+def span(timer, name):
+    if timer is None:
+        yield
+    else:
+        with timer.span(name):
+            yield
+
+
+class TimingHistory:
+    def __init__(self, max_runs=200):
+        self.runs = deque(maxlen=max_runs)
+        self.lock = threading.Lock()
+        self.next_run = 0
+
+    def record(self, timer):
+        with self.lock:
+            self.runs.append({
+                'run': self.next_run,
+                'name': timer.name,
+                'wall_time': timer.wall_time,
+                'total_ms': timer.total_ms(),
+                'spans': list(timer.spans),
+                'counters': dict(timer.counters),
+            })
+            self.next_run += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.runs)
+
+    def stage_table(self):
+        # {stage: [ms per run, None when the run didn't have that stage]} for charts
+        runs = self.snapshot()
+        per_run = [{item['name']: 0.0 for item in run['spans']} for run in runs]
+        for totals, run in zip(per_run, runs):
+            for item in run['spans']:
+                totals[item['name']] += item['duration_ms']
+        stages = list(dict.fromkeys(name for totals in per_run for name in totals))
+        return {stage: [totals.get(stage) for totals in per_run] for stage in stages}
+
+    def to_jsonl(self):
+        lines = []
+        for run in self.snapshot():
+            for item in run['spans']:
+                lines.append(json.dumps({'run': run['run'], 'run_name': run['name'], 'wall_time': run['wall_time'], **item}))
+            lines.append(json.dumps({'run': run['run'], 'run_name': run['name'], 'wall_time': run['wall_time'],
+                                     'total_ms': run['total_ms'], 'counters': run['counters']}))
+        return '\n'.join(lines) + '\n'
+
+    def to_chrome_trace(self):
+        # Complete ('X') events in microseconds, one row (tid) per run
+        events = []
+        for run in self.snapshot():
+            base = run['wall_time'] * 1e6
+            for item in run['spans']:
+                events.append({
+                    'name': item['name'],
+                    'cat': run['name'],
+                    'ph': 'X',
+                    'ts': base + item['start_ms'] * 1000,
+                    'dur': item['duration_ms'] * 1000,
+                    'pid': 1,
+                    'tid': run['run'],
+                })
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
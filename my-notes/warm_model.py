@@ -0,0 +1,101 @@
+'''
+One embedding model per process, loaded in the background.
+
+Importing torch/transformers and loading the sentence-transformers model is
+most of the notes app's cold start. Streamlit re-executes the page script on
+every rerun and for every session, but imported modules stay loaded, so the
+model kept here is shared by all of them. The backend (see embedders.py)
+is built inside the loader thread, torch and langchain included, the page
+renders straight away and only code that actually needs a vector waits for
+the model.
+'''
+import os
+import time
+import threading
+import contextlib
+
+import embedders
+
+_models = {}
+_models_lock = threading.Lock()
+# Thread pool sizes read by numpy, faiss and torch when they are imported
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+class WarmModel:
+    '''Embeddings model that loads on a background thread, embed calls wait until it is ready'''
+
+    def __init__(self, model_name, loader=embedders.load_backend):
+        self.model_name = model_name
+        self.loader = loader
+        self.model = None
+        self.error = None
+        self.timings = {}
+        self.ready = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._load, name=f'warm-{self.model_name}', daemon=True)
+            self.thread.start()
+        return self
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            self.model = self.loader(self.model_name, self.timings)
+        except Exception as error:
+            self.error = error
+        self.timings['cold_start_seconds'] = time.perf_counter() - started
+        self.ready.set()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def status(self):
+        if not self.ready.is_set():
+            return 'warming up'
+        return 'failed' if self.error else 'ready'
+
+    def wait(self, timeout=None):
+        self.start()
+        if not self.ready.wait(timeout):
+            raise TimeoutError(f'{self.model_name} is still warming up')
+        if self.error:
+            raise RuntimeError(f'{self.model_name} failed to load') from self.error
+        return self.model
+
+    def embed_documents(self, texts):
+        return self.wait().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.wait().embed_query(text)
+
+    def stats(self):
+        # Dimension and throughput of the backend once it is loaded
+        if not self.ready.is_set() or self.error or not hasattr(self.model, 'stats'):
+            return {}
+        return self.model.stats()
+
+
+@contextlib.contextmanager
+def pinned_threads(count):
+    # Processes started inside the block use count threads each, this process keeps its own
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: str(count) for name in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def get_model(model_name, loader=embedders.load_backend):
+    # Same instance for every caller in the process, warming starts on first use
+    with _models_lock:
+        if model_name not in _models:
+            _models[model_name] = WarmModel(model_name, loader).start()
+        return _models[model_name]
@@ -0,0 +1,260 @@
+'''
+Keep the notes store in step with a folder of .md and .txt files.
+
+    python watch_folder.py ~/notes-inbox                   # poll every 5 seconds until ctrl-c
+    python watch_folder.py ~/notes-inbox --once            # one pass, then exit
+    python watch_folder.py ~/notes-inbox --delete-missing  # also delete notes whose file is gone
+
+Set WATCH_FOLDER in config.py to have the notes app watch it instead, with
+the page running it is the app that owns the note log.
+
+The folder is polled, nothing is read unless a file's mtime or size changed
+since the checkpoint, my-notes.watch.json:
+    {"version": 1, "folder": "/home/me/notes-inbox",
+     "files": {"ideas/gbq.md": {"mtime_ns": 1722470400000000000, "size": 512, "note_id": "12"}}}
+
+A pass is a chain of generators, scan_folder() -> changed_files() ->
+read_files() -> batches(), so only one batch of file texts is held at a
+time. Every batch is one note log commit, its notes go to index_note()
+(IngestWorker.submit(), which embeds them in batches) and the checkpoint is
+saved after it. A new file is added as a note, a changed file updates the
+note it was added as, so only the delta is embedded. A file with the same
+text as a note typed in the app, or as another file, is left out rather
+than tied to a note it does not own. After a restart the
+checkpoint says which files are already in, and the index catches up with
+the note log as usual when it is loaded.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import config
+import ingest
+import lexical
+import note_log
+import notes_index
+import warm_model
+from embedding_cache import EmbeddingCache
+
+CHECKPOINT_VERSION = 1
+WATCH_SUFFIXES = ('.md', '.txt')
+# A file modified more recently than this may still be being written, it is picked up next pass
+SETTLE_SECONDS = 1.0
+
+
+def scan_folder(folder):
+    # Yields (path relative to folder, os.stat_result) of every .md/.txt file, hidden files and folders skipped
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for name in sorted(names):
+            if name.startswith('.') or not name.lower().endswith(WATCH_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield os.path.relpath(path, folder), stat
+
+
+def changed_files(entries, files, seen, settle_seconds=SETTLE_SECONDS):
+    # Drops files whose mtime and size match the checkpoint, adds every path to seen
+    now = time.time()
+    for path, stat in entries:
+        seen.add(path)
+        checkpoint = files.get(path)
+        if checkpoint and checkpoint['mtime_ns'] == stat.st_mtime_ns and checkpoint['size'] == stat.st_size:
+            continue
+        if now - stat.st_mtime < settle_seconds:
+            continue
+        yield path, stat
+
+
+def parse_note(data):
+    # File bytes to note text, with the newlines the text area would give
+    text = data.decode('utf-8', errors='replace').lstrip('﻿')
+    return text.replace('\r\n', '\n').replace('\r', '\n').strip()
+
+
+def read_files(folder, entries):
+    # Yields (path, stat, text), files removed since the scan are skipped
+    for path, stat in entries:
+        try:
+            with open(os.path.join(folder, path), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            continue
+        yield path, stat, parse_note(data)
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class FolderWatcher:
+    '''Polls a folder and adds new and changed files to a NoteLog, on a background thread'''
+
+    def __init__(self, folder, notes, checkpoint_path, index_note, remove_note=None, batch_size=64, poll_seconds=5):
+        # index_note(note_id, text) is called for every added or changed note once it is in the note log.
+        # Without remove_note(note_id) the notes of removed files are kept
+        self.folder = os.path.abspath(folder)
+        self.notes = notes
+        self.checkpoint_path = checkpoint_path
+        self.index_note = index_note
+        self.remove_note = remove_note
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.files = self._load_checkpoint()
+        self.added = 0
+        self.updated = 0
+        self.removed = 0
+        self.passes = 0
+        self.last_pass = None
+        self.error = None
+        self.thread = None
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r') as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        # A checkpoint of another folder is no use, every file here is new
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('folder') != self.folder:
+            return {}
+        return checkpoint['files']
+
+    def _save_checkpoint(self):
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump({'version': CHECKPOINT_VERSION, 'folder': self.folder, 'files': self.files}, file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def poll(self):
+        # One pass over the folder, returns {'added', 'updated', 'removed'} note counts
+        started = time.perf_counter()
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        seen = set()
+        changed = read_files(self.folder, changed_files(scan_folder(self.folder), self.files, seen))
+        for batch in batches(changed, self.batch_size):
+            self._ingest(batch, counts)
+            self._save_checkpoint()
+        missing = [path for path in self.files if path not in seen]
+        removed = {self.files.pop(path)['note_id'] for path in missing}
+        # A note still linked to another file stays, older checkpoints can have two files on one note
+        removed -= {entry['note_id'] for entry in self.files.values()}
+        for note_id in removed:
+            if self.remove_note is not None and note_id is not None and self.notes.delete(note_id):
+                self.remove_note(note_id)
+                counts['removed'] += 1
+        if missing:
+            self._save_checkpoint()
+        self.added += counts['added']
+        self.updated += counts['updated']
+        self.removed += counts['removed']
+        self.passes += 1
+        self.last_pass = {**counts, 'seconds': time.perf_counter() - started, 'finished': time.time()}
+        return counts
+
+    def _ingest(self, batch, counts):
+        changed = {}
+        new_paths = []
+        for path, stat, text in batch:
+            note_id = self.files.get(path, {}).get('note_id')
+            if not text:
+                # Nothing to add yet, it is read again once it changes
+                pass
+            elif note_id is not None and self.notes.update(note_id, text):
+                changed[note_id] = text
+                counts['updated'] += 1
+            elif note_id is None or self.notes.get(note_id) is None:
+                # New, or its note was deleted in the app since, it comes back as a new note
+                new_paths.append(path)
+            self.files[path] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'note_id': note_id}
+        texts = {path: text for path, _, text in batch}
+        for path in new_paths:
+            self.files[path]['note_id'] = None
+        linked = {entry['note_id'] for entry in self.files.values()}
+        # One commit for all new files of the batch. A file with the text of an existing note only gets that note when
+        # the note came from a file no other file is linked to, otherwise editing or removing the file would change a
+        # note it does not own. Such a file is skipped until it changes
+        for path, (note_id, created) in zip(new_paths, self.notes.add_many([texts[path] for path in new_paths], source='file')):
+            if created:
+                changed[note_id] = texts[path]
+                counts['added'] += 1
+            elif note_id in linked or self.notes.source_of(note_id) != 'file':
+                continue
+            self.files[path]['note_id'] = note_id
+            linked.add(note_id)
+        for note_id, text in changed.items():
+            self.index_note(note_id, text)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='watch-folder', daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+                self.error = None
+            except Exception as error:
+                # Most likely the folder is gone for now, try again next pass
+                self.error = error
+            time.sleep(self.poll_seconds)
+
+    def stats(self):
+        return {'folder': self.folder, 'files': len(self.files), 'added': self.added, 'updated': self.updated,
+                'removed': self.removed, 'passes': self.passes, 'last_pass': self.last_pass, 'error': self.error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder')
+    parser.add_argument('--once', action='store_true', help='one pass over the folder, then exit')
+    parser.add_argument('--delete-missing', action='store_true', help='delete the notes of files that were removed')
+    parser.add_argument('--poll-seconds', type=float, default=config.WATCH_POLL_SECONDS)
+    parser.add_argument('--checkpoint', default=config.WATCH_CHECKPOINT_FILEPATH)
+    args = parser.parse_args()
+    if not os.path.isdir(args.folder):
+        sys.exit(f'{args.folder} is not a folder')
+
+    try:
+        log = note_log.open_notes(config.NOTES_FILEPATH, config.NOTES_LOG_FILEPATH, config.NOTES_SNAPSHOT_FILEPATH)
+    except note_log.NoteLogLocked as error:
+        sys.exit(f'{error}\nSet WATCH_FOLDER in config.py to have the running app watch the folder instead')
+    embeddings = EmbeddingCache(warm_model.get_model(config.EMBEDDING_MODEL_NAME), config.EMBEDDING_MODEL_NAME, config.EMBEDDINGS_DIR)
+    index = notes_index.load_or_build(log.copy_notes(), embeddings, config.INDEX_DIR, config.EMBEDDING_MODEL_NAME,
+                                      config.INDEX_KIND, config.PASSAGES, config.SHARDS)
+    # Only the vector index is saved, the keyword index is rebuilt from the notes whenever the app starts
+    worker = ingest.IngestWorker(lexical.BM25Index(), index, embeddings, config.INDEX_DIR, config.EMBEDDING_MODEL_NAME,
+                                 config.INDEX_KIND, note_log=log, passages=config.PASSAGES, shards=config.SHARDS).start()
+    watcher = FolderWatcher(args.folder, log, args.checkpoint, lambda note_id, text: worker.submit(note_id, text, timeout=None),
+                            worker.delete if args.delete_missing else None, poll_seconds=args.poll_seconds)
+    try:
+        while True:
+            counts = watcher.poll()
+            worker.join()
+            if any(counts.values()):
+                print('{added} added, {updated} updated, {removed} removed'.format(**counts), f'- {len(watcher.files)} files')
+            if args.once:
+                break
+            time.sleep(args.poll_seconds)
+    except KeyboardInterrupt:
+        worker.join()
+    log.close()
+
+
+if __name__ == '__main__':
+    main()